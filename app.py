@@ -1,13 +1,24 @@
 # Import the required modules
 import argparse
+import asyncio
 import logging
-import uvicorn
-from fastapi import FastAPI
+import os
+from fastapi import FastAPI, Response, status
 
 from routers import auth, chats, statistics, stops, algorithm, bus
+from routers.connection_handler import connection_handler
+from routers.database_executor import database_executor
+from routers.message_writer import message_writer
+from routers.positions import position_handler
 from fastapi.middleware.cors import CORSMiddleware
 
 
+logger = logging.getLogger(__name__)
+
+# Compute the routes of every bus line on startup, /ready answers 503 until they are stored
+route_warmup = bool(int(os.environ.get("ROUTE_WARMUP", 0)))
+warmup = {"done": not route_warmup, "report": None, "task": None}
+
 # Create the FastAPI app
 app = FastAPI()
 
@@ -19,6 +30,58 @@ app.include_router(statistics.router)
 app.include_router(stops.router)
 
 
+async def run_route_warmup():
+    try:
+        warmup["report"] = await asyncio.to_thread(bus.warm_up_routes)
+    except Exception as e:
+        # Routes are still computed on first use
+        logger.warning("Route warm-up failed: %s", e)
+    finally:
+        warmup["done"] = True
+
+
+@app.on_event("startup")
+async def start_route_warmup():
+    # In the background, so the process answers liveness checks while it warms up
+    if route_warmup:
+        warmup["task"] = asyncio.create_task(run_route_warmup())
+
+
+@app.on_event("startup")
+async def start_chat_bus():
+    # Chat list previews are updated from the bus, also in workers that serve no chat sockets
+    await connection_handler.bus.start(connection_handler.deliver)
+
+
+@app.get("/ready")
+def ready(response: Response):
+    if not warmup["done"]:
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    return {"ready": warmup["done"], "warmup": warmup["report"]}
+
+
+# Runs first so that pending chat messages are stored and broadcast before the rest shuts down
+@app.on_event("shutdown")
+async def flush_chat_messages():
+    await message_writer.close()
+
+
+@app.on_event("shutdown")
+def shutdown_route_workers():
+    algorithm.route_service.shutdown()
+
+
+@app.on_event("shutdown")
+def shutdown_broadcast_buses():
+    connection_handler.bus.close()
+    position_handler.bus.close()
+
+
+@app.on_event("shutdown")
+def shutdown_database_threads():
+    database_executor.shutdown()
+
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -40,4 +103,6 @@ if __name__ == "__main__":
     args = parser.parse_args()
 
     logging.basicConfig(filename='app.log', level=logging.INFO)
+    # Only needed to serve, importing the app stays cheap for workers and tests
+    import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=args.port)
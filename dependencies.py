@@ -1,17 +1,79 @@
+import os
+import threading
+import time
+from collections import OrderedDict
 from fastapi import status, HTTPException
+from typing import Dict, Optional, Tuple
 
 from models import supabase, User
 
 
+class TokenCache(object):
+
+    entries: "OrderedDict[str, Tuple[User, float]]"
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[User]:
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self.entries.pop(token, None)
+                self.misses += 1
+                return None
+            # Least recently used tokens are evicted first
+            self.entries.move_to_end(token)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token: str, user: User) -> None:
+        with self.lock:
+            self.entries[token] = (user, time.monotonic())
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, token: str) -> None:
+        with self.lock:
+            self.entries.pop(token, None)
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self.lock:
+            for token in [token for token, (user, _) in self.entries.items() if user.id == user_id]:
+                del self.entries[token]
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+# Users of recently seen tokens, kept for TOKEN_CACHE_TTL seconds
+token_cache = TokenCache(
+    ttl=float(os.environ.get("TOKEN_CACHE_TTL", 60)),
+    max_size=int(os.environ.get("TOKEN_CACHE_SIZE", 1024)),
+)
+
+
 # Define a helper function to get the current user from the token
 # def get_current_user(token: str = Depends(oauth2_scheme)):
 def get_current_user(token: str):
+    user = token_cache.get(token)
+    if user is not None:
+        return user
     # Query the user table with the token
     response = supabase.table("users").select("*").eq("token", token).execute()
     # Check if the response has data
     if response.data:
         # Return the user as a User object
-        return User(**response.data[0])
+        user = User(**response.data[0])
+        token_cache.put(token, user)
+        return user
     else:
         # Raise an exception if the token is invalid
         raise HTTPException(
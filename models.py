@@ -1,13 +1,42 @@
 import os
+import threading
 from enum import Enum
 from pydantic import BaseModel
-from supabase import create_client, Client
-from typing import Optional
+from typing import Any, Optional, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from supabase import Client
+
+
+class LazyClient(object):
+    """
+    Supabase client that is created on the first query
+
+    Importing supabase pulls in its HTTP, auth, storage and realtime
+    clients, which would otherwise slow down the start of every process.
+    """
+
+    def __init__(self, url: Optional[str], key: Optional[str]) -> None:
+        self.url = url
+        self.key = key
+        self.client = None
+        self.lock = threading.Lock()
+
+    def get(self) -> "Client":
+        if self.client is None:
+            with self.lock:
+                if self.client is None:
+                    from supabase import create_client
+                    self.client = create_client(self.url, self.key)
+        return self.client
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.get(), name)
 
 
 supabase_url = os.environ.get("SUPABASE_URL", None)
 supabase_key = os.environ.get("SUPABASE_KEY", None)
-supabase: Client = create_client(supabase_url, supabase_key)
+supabase: "Client" = LazyClient(supabase_url, supabase_key)
 
 
 # Define the user entities as an Enum
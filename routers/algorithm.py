@@ -1,114 +1,85 @@
-import pandas as pd
-import numpy as np
-import routingpy as rp
-from python_tsp.exact import solve_tsp_dynamic_programming
+import logging
 import os
+import time
 from fastapi import status, APIRouter, HTTPException
-from models import supabase
-from shapely import wkb
+
+from routers.geometry import decode_points
+from routers.route_service import RouteService
+from routers.solver import solve_route
+from routers.stop_loader import load_bus_stops
+from routers.travel_time_providers import create_provider
+from routers.travel_time_store import TravelTimeStore
 
 router = APIRouter(prefix="/algorithm", tags=["Algorithm"])
 
-graphhopper_api_key = os.environ.get("GRAPHOPPER_API_KEY", None)
+logger = logging.getLogger(__name__)
 
-client_graphhopper = rp.Graphhopper(api_key=graphhopper_api_key)
+# One of "graphhopper", "haversine" or "matrix_file"
+travel_time_provider = create_provider(os.environ.get("TRAVEL_TIME_PROVIDER", "graphhopper"), os.environ)
+# Provider used when the main one fails, travel times from it are never persisted
+travel_time_fallback_name = os.environ.get("TRAVEL_TIME_FALLBACK", None)
+travel_time_fallback = create_provider(travel_time_fallback_name, os.environ) if travel_time_fallback_name else None
+
+# Travel times persisted across restarts, refreshed once older than the TTL (in seconds)
+travel_time_store = TravelTimeStore(
+    path=os.environ.get("TRAVEL_TIME_CACHE_PATH", "travel_times.sqlite"),
+    ttl=float(os.environ.get("TRAVEL_TIME_TTL", 7 * 24 * 3600)),
+)
 
 
-# TODO does not depend on a user
-@router.get("/tsp")
 def tsp_algorithm(bus_id: int = 0):
+    start = time.perf_counter()
     # Prepare data
-    response = supabase\
-        .table("bus_stop_mappings")\
-        .select("*")\
-        .eq("bus_id", bus_id)\
-        .execute()
-    bus_stop_data = response.data
-    if not bus_stop_data:
+    bus_stops = load_bus_stops([bus_id])
+    if bus_id not in bus_stops:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Specified bus line doesn't exist",
         )
-    bus_stop_ids = [item['stop_id'] for item in bus_stop_data]
-    all_stops = []
-    for stop_id in bus_stop_ids:
-        stop_response = supabase\
-            .table("stops")\
-            .select("*")\
-            .eq("is_active", True)\
-            .eq("stop_id", stop_id)\
-            .execute()
-        all_stops.extend(stop_response.data)
-    df = pd.DataFrame(
-        [
-            {
-                'long': wkb.loads(loc['location'], hex=True).x,
-                'lat': wkb.loads(loc['location'], hex=True).y
-            }
-            for loc in all_stops
-        ]
-    )
-    df = df.astype(float)
-    df = df.values
+    result = solve_stops(bus_stops[bus_id])
+    # Unlike elapsed_ms of the solver, includes loading the stops and the travel times
+    result["report"]["total_ms"] = round((time.perf_counter() - start) * 1000, 3)
+    return result
+
+
+# Solves routes in worker processes, one computation per bus line at a time
+route_service = RouteService(tsp_algorithm, max_workers=int(os.environ.get("ROUTE_WORKERS", 2)))
+
+
+# TODO does not depend on a user
+@router.get("/tsp")
+async def get_tsp(bus_id: int = 0):
+    return await route_service.compute_async(bus_id)
+
+
+def solve_stops(all_stops):
+    coordinates = stop_coordinates(all_stops)
 
     try:
-        durations = get_time_matrix(df)
+        durations = get_time_matrix(coordinates)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Couldn't calculate route: {e}",
         )
-    # print(durations)
-    sym_matrix = symmetricize(durations)
-    points = solve_tcp(sym_matrix)
+    points, report = solve_route(durations)
     sorted_stops = [all_stops[i] for i in points]
-    # print(sorted_stops)
-    return {"stops": sorted_stops}
+    return {"stops": sorted_stops, "report": report}
 
 
-# def prepare_data(points):
-#     df = pd.DataFrame(points)
-#     df = df['points'].apply(pd.Series)
-#     df[['id', 'name', 'lat', 'long']] = df\
-#         .apply(
-#             lambda row: pd.Series({'id': row['id'], 'name': row['name'], 'lat': row['lat'], 'long': row['long']}),
-#             axis=1
-#         )
-#     return df
-
-# def get_coordinates(df):
-#     df['long'], df['lat'] = zip(*df['location'].apply(lambda loc: (loc.longitude, loc.latitude)))
-#     coordinates = df[['long', 'lat']].values
-#     return coordinates
+def stop_coordinates(stops):
+    return decode_points([stop["location"] for stop in stops])
 
 
 def get_time_matrix(coordinates):
-    # TODO check if bus is available
-    matrix = client_graphhopper.matrix(locations=coordinates, profile='car')
-    durations = np.matrix(matrix.durations)
-    return durations
-
-
-def symmetricize(m, high_int=None):
-    # if high_int not provided, make it equal to 10 times the max value:
-    # this is a hack to make sure that the matrix solution ignores one part of the matrix
-    if high_int is None:
-        high_int = round(10 * m.max())
-    m_bar = m.copy()
-    np.fill_diagonal(m_bar, 0)
-    u = np.matrix(np.ones(m.shape) * high_int)
-    np.fill_diagonal(u, 0)
-    m_symm_top = np.concatenate((u, np.transpose(m_bar)), axis=1)
-    m_symm_bottom = np.concatenate((m_bar, u), axis=1)
-    m_symm = np.concatenate((m_symm_top, m_symm_bottom), axis=0)
-    # Concorde requires integer weights
-    return m_symm.astype(int)
-
-
-def solve_tcp(symmetric_matrix, comeback: bool = False):
-    if not comeback:
-        # doesn't come back to the start
-        symmetric_matrix[:, 0] = 0
-    permutation, _ = solve_tsp_dynamic_programming(symmetric_matrix)
-    tour = permutation[::2]
-    return tour
+    locations = [list(coordinate) for coordinate in coordinates]
+    everything = list(range(len(locations)))
+    try:
+        if travel_time_provider.cached:
+            return travel_time_store.get_matrix(locations, travel_time_provider.matrix)
+        return travel_time_provider.matrix(locations, everything, everything)
+    except Exception as e:
+        if travel_time_fallback is None:
+            raise
+        logger.warning("Travel time provider failed, using %s: %s", travel_time_fallback_name, e)
+        return travel_time_fallback.matrix(locations, everything, everything)
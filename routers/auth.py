@@ -1,8 +1,8 @@
 from fastapi import status, APIRouter, Depends, HTTPException
 from fastapi.security import OAuth2PasswordBearer
 
-from dependencies import get_current_user
-from models import supabase, User, Settings
+from dependencies import get_current_user, token_cache
+from models import supabase, User, UserEntity, Settings
 
 
 router = APIRouter(prefix="/auth", tags=["auth"])
@@ -66,6 +66,9 @@ def login(email: str, password: str):
         supabase.table("users").update({"token": token}).eq(
             "id", response.data[0]["id"]
         ).execute()
+        # Drop the users cached under the previous token and the new one
+        token_cache.invalidate_user(response.data[0]["id"])
+        token_cache.invalidate(token)
         # Return the token
         return {"access_token": token, "token_type": "bearer"}
     else:
@@ -83,6 +86,7 @@ def update_settings(settings: Settings, current_user: User = Depends(get_current
     # supabase.table("settings").update(settings.model_dump()).eq("id", response.data[0]["id"]).execute()
     settings_dict = settings.dict(exclude_unset=True)
     supabase.table("users").update(settings_dict).eq("id", current_user.id).execute()
+    token_cache.invalidate_user(current_user.id)
     # Return the updated settings
     return settings
 
@@ -90,6 +94,7 @@ def update_settings(settings: Settings, current_user: User = Depends(get_current
 @router.put("/change_password")
 def update_password(password: str, current_user: User = Depends(get_current_user)):
     supabase.table("users").update({"password": password}).eq("id", current_user.id).execute()
+    token_cache.invalidate_user(current_user.id)
     # Return the updated settings
     return {"status": "success"}
 
@@ -109,3 +114,14 @@ def get_settings(current: User = Depends(get_current_user)):
 @router.get("/me")
 def me(current_user: User = Depends(get_current_user)):
     return current_user
+
+
+# Send the hit and miss counts of the token cache
+@router.get("/metrics")
+def get_auth_metrics(current_user: User = Depends(get_current_user)):
+    if current_user.entity != UserEntity.manager:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only parcel operators can get authentication metrics",
+        )
+    return token_cache.stats()
@@ -0,0 +1,163 @@
+import asyncio
+import glob
+import json
+import logging
+import os
+import time
+import uuid
+from typing import Any, Callable, Dict, Optional
+
+
+logger = logging.getLogger(__name__)
+
+# Receives the chat id and the message to deliver to the sockets of this process
+Deliver = Callable[[int, Any], None]
+
+# Longest line of JSON a process accepts from the others
+MAX_LINE_SIZE = 1024 * 1024
+
+
+class BroadcastBus(object):
+
+    async def start(self, deliver: Deliver) -> None:
+        """
+        Starts receiving messages published by any process
+
+        Calling it again does nothing.
+
+        Parameters:
+        - deliver: Called with every message published to the bus, including the ones of this process.
+        """
+        raise NotImplementedError
+
+    async def publish(self, chat_id: int, message: Any) -> None:
+        """
+        Sends a JSON-serializable message to the sockets of a chat in every process
+
+        Parameters:
+        - chat_id: The chat.
+        - message: The message.
+        """
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
+
+
+class InProcessBroadcastBus(BroadcastBus):
+
+    def __init__(self) -> None:
+        self.deliver = None
+
+    async def start(self, deliver):
+        self.deliver = deliver
+
+    async def publish(self, chat_id, message):
+        if self.deliver is not None:
+            self.deliver(chat_id, message)
+
+
+class UnixSocketBroadcastBus(BroadcastBus):
+    """
+    Broadcast bus between the worker processes of one host
+
+    Every process that serves chat sockets listens on a Unix socket in a
+    shared directory. Publishing delivers locally and writes one line of JSON
+    to a kept-open connection to every other socket found there, so there is
+    no broker to run. Writes are not awaited, a peer that stops reading only
+    loses messages once its write buffer exceeds max_buffer_size bytes.
+    The directory is scanned for new peers every discovery_interval seconds.
+    Sockets left behind by dead workers are removed by the first publisher
+    that can't reach them.
+    """
+
+    peers: Dict[str, asyncio.StreamWriter]
+
+    def __init__(self, directory: str, max_buffer_size: int, discovery_interval: float) -> None:
+        self.directory = directory
+        self.max_buffer_size = max_buffer_size
+        self.discovery_interval = discovery_interval
+        self.paths = []
+        self.discovered_at = None
+        self.path = None
+        self.server = None
+        self.peers = dict()
+        self.deliver = None
+
+    async def start(self, deliver):
+        if self.server is not None:
+            return
+        self.deliver = deliver
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"{os.getpid()}-{uuid.uuid4().hex[:8]}.sock")
+        self.server = await asyncio.start_unix_server(self.receive, self.path, limit=MAX_LINE_SIZE)
+
+    async def receive(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            while line := await reader.readline():
+                event = json.loads(line)
+                self.deliver(event["chat_id"], event["message"])
+        except (ConnectionError, ValueError) as e:
+            logger.warning("Dropping broadcast bus connection: %s", e)
+        finally:
+            writer.close()
+
+    async def connect(self, path: str) -> Optional[asyncio.StreamWriter]:
+        writer = self.peers.get(path)
+        if writer is not None and not writer.is_closing():
+            return writer
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except (ConnectionRefusedError, FileNotFoundError):
+            # Nobody listens on it anymore
+            self.peers.pop(path, None)
+            self.paths.remove(path)
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            return None
+        self.peers[path] = writer
+        return writer
+
+    async def publish(self, chat_id, message):
+        if self.deliver is not None:
+            self.deliver(chat_id, message)
+        payload = json.dumps({"chat_id": chat_id, "message": message}, default=str).encode() + b"\n"
+        if self.discovered_at is None or time.monotonic() - self.discovered_at > self.discovery_interval:
+            self.paths = [path for path in glob.glob(os.path.join(self.directory, "*.sock")) if path != self.path]
+            self.discovered_at = time.monotonic()
+        for path in list(self.paths):
+            writer = await self.connect(path)
+            if writer is None:
+                continue
+            if writer.transport.get_write_buffer_size() > self.max_buffer_size:
+                logger.warning("Broadcast bus peer %s is not reading, dropping message of chat %s", path, chat_id)
+                continue
+            writer.write(payload)
+
+    def close(self):
+        for writer in self.peers.values():
+            writer.close()
+        self.peers = dict()
+        if self.server is None:
+            return
+        self.server.close()
+        self.server = None
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def create_broadcast_bus(name: str, settings: Dict[str, str], namespace: str) -> BroadcastBus:
+    # Every namespace is a separate bus, so channel ids of different namespaces never collide
+    if name == "memory":
+        return InProcessBroadcastBus()
+    if name == "unix":
+        return UnixSocketBroadcastBus(
+            directory=os.path.join(settings.get("BROADCAST_BUS_DIRECTORY", "/tmp/broadcast"), namespace),
+            max_buffer_size=int(settings.get("BROADCAST_BUS_BUFFER_SIZE", 4 * 1024 * 1024)),
+            discovery_interval=float(settings.get("BROADCAST_BUS_DISCOVERY_INTERVAL", 1)),
+        )
+    raise ValueError(f"Unknown broadcast bus {name}")
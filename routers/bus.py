@@ -1,42 +1,155 @@
-from fastapi import status, APIRouter, HTTPException, Depends
+import logging
+import os
+import time
+from concurrent.futures import as_completed
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from fastapi import status, APIRouter, HTTPException, Depends, WebSocket, WebSocketDisconnect
 
 from dependencies import get_current_user
 from models import supabase, User, UserEntity, StopEntity
-from routers.algorithm import tsp_algorithm
+from routers.algorithm import route_service, get_time_matrix, stop_coordinates
+from routers.database_executor import run_blocking
+from routers.line_index import stop_line_index
+from routers.positions import ALL_BUSES, position_handler, publish_position, publish_position_async
+from routers.route import Route
+from routers.route_store import create_route_store
+from routers.solver import cheapest_insertion
+from routers.spatial_index import stop_index
+from routers.stop_counters import stop_counters
+from routers.stop_loader import load_stops
 
 router = APIRouter(prefix="/bus", tags=["bus"])
 
-# TODO reconstruct route on new stop creation
-# Cached bus routes
-bus_routes = dict()
-# Cached results of build_next_stops
+logger = logging.getLogger(__name__)
+
+# Share of stops inserted since the last full solve that triggers a re-optimization
+route_reoptimize_drift = float(os.environ.get("ROUTE_REOPTIMIZE_DRIFT", 0.25))
+# Seconds after which a route with inserted stops is re-optimized from scratch
+route_reoptimize_interval = float(os.environ.get("ROUTE_REOPTIMIZE_INTERVAL", 600))
+
+# Number of attempts to apply a route change before giving up on concurrent writers
+route_write_attempts = int(os.environ.get("ROUTE_WRITE_ATTEMPTS", 5))
+
+# Bus routes shared by every worker: "memory" keeps them in this process, "sqlite" in ROUTE_STORE_PATH.
+# buses.stop_number is the position of the bus in the stored route, which keeps its order in both
+# directions. Rows of buses started before routes were stored held an index into the route as seen
+# in the driving direction, so buses driving backwards at the upgrade have to be started again.
+route_store = create_route_store(os.environ.get("ROUTE_STORE", "memory"), os.environ)
+# Cached results of build_next_stops keyed by route version, cursor and number of stops
 build_next_stops_cache = dict()
 
 
+def compute_route(bus_id: int, replace: bool = False) -> Tuple[Route, int]:
+    # A replacement follows a change of the stops, so it must not reuse a solve that started before it.
+    # Results are shared with concurrent callers, so the stops are copied.
+    result = route_service.compute(bus_id, fresh=replace)
+    return store_route(bus_id, Route(list(result["stops"])), replace)
+
+
+def store_route(bus_id: int, route: Route, replace: bool = False) -> Tuple[Route, int]:
+    while True:
+        entry = route_store.get(bus_id)
+        if entry is not None and not replace:
+            # Another worker stored the route first
+            return entry
+        version = route_store.compare_and_set(bus_id, route, 0 if entry is None else entry[1])
+        if version:
+            return route, version
+
+
+def warm_up_routes() -> Dict[str, Any]:
+    """
+    Computes the routes of every bus line that has none stored, in parallel on the route workers
+
+    Returns:
+    The solver report of every line, keyed by bus id, the lines that failed and the total time.
+    """
+    start = time.perf_counter()
+    bus_ids = [bus_id for bus_id in stop_line_index.bus_ids() if not route_store.version(bus_id)]
+    futures = {route_service.submit(bus_id): bus_id for bus_id in bus_ids}
+    lines = dict()
+    failed = dict()
+    for future in as_completed(futures):
+        bus_id = futures[future]
+        try:
+            result = future.result()
+        except Exception as e:
+            failed[bus_id] = getattr(e, "detail", str(e))
+            logger.warning("Couldn't warm up route of bus %s: %s", bus_id, failed[bus_id])
+            continue
+        store_route(bus_id, Route(list(result["stops"])))
+        lines[bus_id] = {**result["report"], "ready_after_ms": round((time.perf_counter() - start) * 1000, 3)}
+        logger.info("Warmed up route of bus %s: %s", bus_id, lines[bus_id])
+    report = {"lines": lines, "failed": failed, "elapsed_ms": round((time.perf_counter() - start) * 1000, 3)}
+    logger.info("Warmed up %s routes in %sms, %s failed", len(lines), report["elapsed_ms"], len(failed))
+    return report
+
+
+async def ensure_route(bus_id: int) -> None:
+    # Async handlers wait for a missing route on the route workers instead of holding a thread
+    if not await run_blocking(route_store.version, bus_id):
+        result = await route_service.compute_async(bus_id)
+        await run_blocking(store_route, bus_id, Route(list(result["stops"])))
+
+
+def load_route(bus_id: int) -> Tuple[Route, int]:
+    # The route may be shared with other requests, only mutate_route changes a copy of it
+    entry = route_store.get(bus_id)
+    if entry is None:
+        return compute_route(bus_id)
+    return entry
+
+
+def mutate_route(bus_id: int, mutate: Callable[[Route], Any]) -> Tuple[Route, int, Any]:
+    # Applies mutate to the latest route until no other writer interferes
+    for _ in range(route_write_attempts):
+        route, version = load_route(bus_id)
+        route = route.copy()
+        result = mutate(route)
+        version = route_store.compare_and_set(bus_id, route, version)
+        if version:
+            return route, version, result
+    raise HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail="Route was modified concurrently, try again",
+    )
+
+
 @router.post("/start")
-def start_bus(current_user: User = Depends(get_current_user), bus_id: int = 0):
+async def start_bus(current_user: User = Depends(get_current_user), bus_id: int = 0):
     if current_user.entity != UserEntity.driver:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Only drivers can start the bus",
         )
-    response = supabase.rpc('check_availability', {"p_driver_id": current_user.id, "p_bus_id": bus_id}).execute()
+    check = supabase.rpc('check_availability', {"p_driver_id": current_user.id, "p_bus_id": bus_id})
+    response = await run_blocking(check.execute)
     if response.data:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Bus or driver are already busy",
         )
-    if bus_id not in bus_routes:
-        bus_routes[bus_id] = tsp_algorithm(bus_id=bus_id)["stops"]
+    await ensure_route(bus_id)
+    next_stops, event = await run_blocking(place_bus, current_user, bus_id)
+    await publish_position_async(event)
+    return next_stops
+
+
+def place_bus(current_user: User, bus_id: int) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    route, version = load_route(bus_id)
+    # Buses start at the first active stop of the route, driving towards its end
+    stop_number = 0 if route.active[0] else route.step(0, True)[0]
     response = supabase.table("buses").insert([{
         "bus_id": bus_id,
         "driver_id": current_user.id,
-        "stop_number": 0,
-        "lat": bus_routes[bus_id][0]["lat"],
-        "long": bus_routes[bus_id][0]["long"]
+        "stop_number": stop_number,
+        "direction": True,
+        "lat": route.stops[stop_number]["lat"],
+        "long": route.stops[stop_number]["long"]
     }]).execute()
     if response.data:
-        return build_next_stops(bus_id, cached=False)
+        next_stops = build_next_stops(bus_id, route, version, current_stop_i=stop_number, cached=False)
+        return next_stops, position_event(next_stops, stop_number, True)
     else:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -46,53 +159,123 @@ def start_bus(current_user: User = Depends(get_current_user), bus_id: int = 0):
 
 @router.post("/stop")
 def stop_bus(current_user: User = Depends(get_current_user)):
+    # Only buses that were driving are announced as stopped
+    active_buses = supabase.table("buses")\
+        .select("bus_id")\
+        .eq("driver_id", current_user.id)\
+        .eq("is_active", True)\
+        .execute()\
+        .data
     # Set is_active to False
     # Implicit check whether user is a driver and has active buses
     response = supabase.table("buses").update({"is_active": False}).eq("driver_id", current_user.id).execute()
+    for bus in active_buses:
+        publish_position({"bus_id": bus["bus_id"], "active": False})
     return {"data": response.data}
 
 
-@router.post("/next")
-def move_to_next_stop(current_user: User = Depends(get_current_user)):
-    # Implicit check whether user is a driver and has active buses
+def load_driver_bus(driver_id: int) -> Optional[Dict[str, Any]]:
     response = supabase.table("buses")\
         .select("*")\
-        .eq("driver_id", current_user.id)\
+        .eq("driver_id", driver_id)\
         .eq("is_active", True)\
         .execute()
-    if not response.data:
+    return response.data[0] if response.data else None
+
+
+@router.post("/next")
+async def move_to_next_stop(current_user: User = Depends(get_current_user)):
+    # Implicit check whether user is a driver and has active buses
+    bus = await run_blocking(load_driver_bus, current_user.id)
+    if bus is None:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="No active buses associated with the user",
         )
-    bus = response.data[0]
+    await ensure_route(bus["bus_id"])
+    next_stops, event = await run_blocking(advance_bus, bus)
+    await publish_position_async(event)
+    return next_stops
+
+
+def advance_bus(bus: Dict[str, Any]) -> Tuple[Dict[str, Any], Dict[str, Any]]:
     row_id = bus["id"]
     bus_id = bus["bus_id"]
     direction = bus["direction"]
     current_stop_i = bus["stop_number"]
-    if bus_id not in bus_routes:
-        # returns route for True order
-        bus_routes[bus_id] = tsp_algorithm(bus_id=bus_id)["stops"]
-        if not direction:
-            bus_routes[bus_id].reverse()
-    bus_route = bus_routes[bus_id]
-    current_stop = bus_route[current_stop_i]
-    if current_stop["entity"] != StopEntity.static.value:
-        response = supabase.table("stops").update({"is_active": False}).eq("stop_id", current_stop["stop_id"]).execute()
-        del bus_route[current_stop_i]
-        next_stop_i = current_stop_i
+    for _ in range(route_write_attempts):
+        route, version = load_route(bus_id)
+        # stop_number is the position of the bus in the route, which stays valid in both directions
+        next_stop_i, next_direction = route.step(current_stop_i, direction)
+        current_stop = route.stops[current_stop_i]
+        if not route.is_dynamic(current_stop_i) or not route.active[current_stop_i]:
+            # Nothing to write, the cursor itself lives in the buses table
+            break
+        # Only the served stop is written, not the whole route
+        version = route_store.consume(bus_id, current_stop_i, version)
+        if version:
+            route, version = load_route(bus_id)
+            break
     else:
-        next_stop_i = current_stop_i + 1
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Route was modified concurrently, try again",
+        )
     update_dict = dict()
-    if next_stop_i == len(bus_route):
-        next_stop_i = (next_stop_i + 1) % len(bus_route)
-        bus_route.reverse()
-        update_dict["direction"] = not direction
+    if next_direction != direction:
+        update_dict["direction"] = next_direction
     update_dict["stop_number"] = next_stop_i
-    update_dict["lat"] = bus_route[next_stop_i]["lat"]
-    update_dict["long"] = bus_route[next_stop_i]["long"]
-    response = supabase.table("buses").update(update_dict).eq("id", row_id).execute()
-    return build_next_stops(bus_id, current_stop_i=next_stop_i, cached=False)
+    update_dict["lat"] = route.stops[next_stop_i]["lat"]
+    update_dict["long"] = route.stops[next_stop_i]["long"]
+    if current_stop["entity"] != StopEntity.static.value:
+        supabase.table("stops").update({"is_active": False}).eq("stop_id", current_stop["stop_id"]).execute()
+        stop_index.remove(current_stop["stop_id"])
+        stop_counters.served(current_stop["entity"])
+    supabase.table("buses").update(update_dict).eq("id", row_id).execute()
+    next_stops = build_next_stops(
+        bus_id,
+        route,
+        version,
+        current_stop_i=next_stop_i,
+        direction=next_direction,
+        cached=False
+    )
+    return next_stops, position_event(next_stops, next_stop_i, next_direction)
+
+
+def route_needs_reoptimization(route: Route) -> bool:
+    if route.insertions == 0:
+        return False
+    if time.time() - route.solved_at > route_reoptimize_interval:
+        return True
+    return route.insertions > route_reoptimize_drift * route.size
+
+
+def insert_stop(bus_id: int, stop_id: int) -> Tuple[int, bool]:
+    # Put the new stop at its cheapest position among the active stops of the stored route
+    stop = load_stops([stop_id])[0]
+
+    def insert(route: Route):
+        position = route.find(stop_id)
+        if position is not None:
+            # The route was recomputed with the new stop in the meantime
+            return position, False
+        active_is = [i for i, active in enumerate(route.active) if active]
+        # Only the row and the column of the new stop are missing from the travel time store
+        durations = get_time_matrix(stop_coordinates([route.stops[i] for i in active_is] + [stop]))
+        new_i = len(active_is)
+        active_position, added = cheapest_insertion(
+            list(range(new_i)),
+            new_i,
+            lambda stop_from, stop_to: durations[stop_from, stop_to]
+        )
+        position = active_is[active_position] if active_position < new_i else len(route.stops)
+        route.insert(position, stop)
+        logger.info("Inserted stop %s into route of bus %s at %s (+%ss)", stop_id, bus_id, position, added)
+        return position, True
+
+    _, _, (position, inserted) = mutate_route(bus_id, insert)
+    return position, inserted
 
 
 def update_route(bus_id: int, stop_id: int):
@@ -101,32 +284,44 @@ def update_route(bus_id: int, stop_id: int):
         .eq("bus_id", bus_id)\
         .eq("is_active", True)\
         .execute()
-    if not response.data:
-        # No active buses
+    bus = response.data[0] if response.data else None
+    entry = route_store.get(bus_id)
+    old_route = None if entry is None else entry[0]
+    inserted_at = None
+    if old_route is not None and not route_needs_reoptimization(old_route):
+        try:
+            inserted_at, inserted = insert_stop(bus_id, stop_id)
+        except Exception as e:
+            logger.warning("Couldn't insert stop %s into route of bus %s: %s", stop_id, bus_id, e)
+    if inserted_at is not None:
+        # Positions after the new stop moved by one
+        if bus is not None and inserted and bus["stop_number"] >= inserted_at:
+            response = supabase.table("buses")\
+                .update({"stop_number": bus["stop_number"] + 1})\
+                .eq("id", bus["id"])\
+                .execute()
         return
-    bus = response.data[0]
-    row_id = bus["id"]
-    bus_id = bus["bus_id"]
-    direction = bus["direction"]
-    current_stop_i = bus["stop_number"]
-    # Returns route for True order
-    bus_routes[bus_id] = tsp_algorithm(bus_id=bus_id)["stops"]
-    if not direction:
-        bus_routes[bus_id].reverse()
-    if current_stop_i >= find_stop_index_by_id(bus_routes[bus_id], stop_id):
-        response = supabase.table("buses").update({"stop_number": current_stop_i + 1}).eq("id", row_id).execute()
+    if bus is None:
+        # No active buses: the route is computed when it is needed next
+        route_store.delete(bus_id)
+        return
+    route, _ = compute_route(bus_id, replace=True)
+    # Every position may have changed, keep the bus at the stop it is at
+    stop_number = None
+    if old_route is not None and bus["stop_number"] < len(old_route.stops):
+        stop_number = route.find(old_route.stops[bus["stop_number"]]["stop_id"])
+    if stop_number is None:
+        stop_number = 0
+    response = supabase.table("buses").update({
+        "stop_number": stop_number,
+        "lat": route.stops[stop_number]["lat"],
+        "long": route.stops[stop_number]["long"]
+    }).eq("id", bus["id"]).execute()
     return
 
 
-def find_stop_index_by_id(stops, stop_id):
-    for index, item in enumerate(stops):
-        if item.get("stop_id") == stop_id:
-            return index
-    return None
-
-
 @router.get("/list_stops")
-def list_next_stops(current_user: User = Depends(get_current_user), num_next_stops: int = 3):
+async def list_next_stops(current_user: User = Depends(get_current_user), num_next_stops: int = 3):
     """
     Lists current stop and next N stops
 
@@ -146,43 +341,133 @@ def list_next_stops(current_user: User = Depends(get_current_user), num_next_sto
             status_code=status.HTTP_403_FORBIDDEN,
             detail="User is not a driver",
         )
-    response = supabase.table("buses")\
-        .select("*")\
-        .eq("driver_id", current_user.id)\
-        .eq("is_active", True)\
-        .execute()
-    if not response.data:
+    bus = await run_blocking(load_driver_bus, current_user.id)
+    if bus is None:
         return {"bus_id": None, "current_stop": None, "next_stops": None}
-    bus = response.data[0]
-    bus_id = bus["bus_id"]
-    if bus_id not in bus_routes:
-        # returns route for True order
-        bus_routes[bus_id] = tsp_algorithm(bus_id=bus_id)["stops"]
-        if not bus["direction"]:
-            bus_routes[bus_id].reverse()
-    return build_next_stops(bus_id=bus_id, current_stop_i=bus["stop_number"], num_next_stops=num_next_stops)
-
-
-def build_next_stops(bus_id: int, current_stop_i: int = 0, num_next_stops: int = 3, cached: bool = True):
-    if cached and (bus_id in build_next_stops_cache):
-        return build_next_stops_cache[bus_id]
-    bus_route = bus_routes[bus_id].copy()
-    next_stops = list()
-    for _ in range(num_next_stops + 1):
-        next_stops.append(bus_route[current_stop_i])
-        if bus_route[current_stop_i]["entity"] != StopEntity.static.value:
-            del bus_route[current_stop_i]
-        else:
-            current_stop_i += 1
-        if current_stop_i == len(bus_route):
-            bus_route.reverse()
-            # bus_route must contain at least one static stop
-            current_stop_i = 1 % len(bus_route)
+    await ensure_route(bus["bus_id"])
+    return await run_blocking(bus_next_stops, bus, num_next_stops)
+
+
+def bus_next_stops(bus: Dict[str, Any], num_next_stops: int = 3) -> Dict[str, Any]:
+    # Polls mostly hit the cache, which only needs the version of the route
+    version = route_store.version(bus["bus_id"])
+    key = next_stops_key(bus["bus_id"], version, bus["stop_number"], bus["direction"], num_next_stops)
+    if key in build_next_stops_cache:
+        return build_next_stops_cache[key]
+    route, version = load_route(bus["bus_id"])
+    return build_next_stops(
+        bus["bus_id"],
+        route,
+        version,
+        current_stop_i=bus["stop_number"],
+        direction=bus["direction"],
+        num_next_stops=num_next_stops
+    )
+
+
+def next_stops_key(bus_id: int, version: int, current_stop_i: int, direction: bool, num_next_stops: int):
+    return bus_id, version, current_stop_i, direction, num_next_stops
+
+
+def build_next_stops(
+        bus_id: int,
+        route: Route,
+        version: int,
+        current_stop_i: int = 0,
+        direction: bool = True,
+        num_next_stops: int = 3,
+        cached: bool = True
+):
+    key = next_stops_key(bus_id, version, current_stop_i, direction, num_next_stops)
+    if cached and key in build_next_stops_cache:
+        return build_next_stops_cache[key]
+    next_stops = route.next_stops(current_stop_i, direction, num_next_stops)
     result = {"bus_id": bus_id, "current_stop": next_stops[0], "next_stops": next_stops[1:]}
-    build_next_stops_cache[bus_id] = result
+    if route_store.version(bus_id) != version:
+        # A stop was served in place while the route was walked, the result may mix both versions
+        return result
+    # Results of older route versions are never requested again
+    stale_keys = [item for item in build_next_stops_cache if item[0] == bus_id and item[1] != version]
+    for stale_key in stale_keys:
+        del build_next_stops_cache[stale_key]
+    build_next_stops_cache[key] = result
     return result
 
 
+def position_event(next_stops: Dict[str, Any], stop_number: int, direction: bool) -> Dict[str, Any]:
+    return {
+        **next_stops,
+        "active": True,
+        "stop_number": stop_number,
+        "direction": direction,
+        "lat": next_stops["current_stop"]["lat"],
+        "long": next_stops["current_stop"]["long"],
+    }
+
+
+def load_active_buses(channel: int) -> List[Dict[str, Any]]:
+    query = supabase.table("buses").select("*").eq("is_active", True)
+    if channel != ALL_BUSES:
+        query = query.eq("bus_id", channel)
+    return query.execute().data
+
+
+async def current_positions(channel: int) -> List[Dict[str, Any]]:
+    buses = await run_blocking(load_active_buses, channel)
+    events = []
+    for bus in buses:
+        await ensure_route(bus["bus_id"])
+        next_stops = await run_blocking(bus_next_stops, bus)
+        events.append(position_event(next_stops, bus["stop_number"], bus["direction"]))
+    if not events and channel != ALL_BUSES:
+        events.append({"bus_id": channel, "active": False})
+    return events
+
+
+async def stream_positions(websocket: WebSocket, current_user: User, channel: int) -> None:
+    connection = await position_handler.register(channel, current_user.id, websocket)
+    try:
+        # Current positions first, then an event whenever a bus starts, moves or stops
+        for event in await current_positions(channel):
+            connection.offer(event)
+        while True:
+            await websocket.receive_text()
+    except WebSocketDisconnect:
+        pass
+    finally:
+        position_handler.close(channel, current_user.id, connection)
+
+
+def followed_line(current_user: User) -> Optional[int]:
+    # The line a driver drives or a passenger rides, None without one
+    if current_user.entity == UserEntity.driver:
+        bus = load_driver_bus(current_user.id)
+        return bus["bus_id"] if bus else None
+    buses = supabase.rpc('bus_for_passenger', {"p_user_id": current_user.id}).execute().data
+    return buses[0]["bus_id"] if buses else None
+
+
+# Push the position and next stops of the bus driving a line,
+# managers follow any line, drivers and passengers only their own
+@router.websocket("/positions/{bus_id}")
+async def subscribe_bus_position(websocket: WebSocket, bus_id: int, current_user: User = Depends(get_current_user)):
+    await websocket.accept()
+    if current_user.entity != UserEntity.manager and await run_blocking(followed_line, current_user) != bus_id:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await stream_positions(websocket, current_user, bus_id)
+
+
+# Push the positions of every bus, for managers
+@router.websocket("/positions")
+async def subscribe_bus_positions(websocket: WebSocket, current_user: User = Depends(get_current_user)):
+    await websocket.accept()
+    if current_user.entity != UserEntity.manager:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    await stream_positions(websocket, current_user, ALL_BUSES)
+
+
 # List bus lines that are not taken by any driver
 @router.get("/lines")
 def list_bus_lines(current_user: User = Depends(get_current_user)):
@@ -191,9 +476,8 @@ def list_bus_lines(current_user: User = Depends(get_current_user)):
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Only drivers can view bus lines list",
         )
-    # Fetch all bus_ids from bus_stop_mappings
-    response = supabase.table("bus_stop_mappings").select("bus_id").execute()
-    bus_ids_in_mappings = [item["bus_id"] for item in response.data]
+    # All bus_ids from bus_stop_mappings
+    bus_ids_in_mappings = stop_line_index.bus_ids()
     # Fetch all active bus_ids from buses
     response = supabase.table("buses").select("bus_id").eq("is_active", True).execute()
     bus_ids_in_buses = [item["bus_id"] for item in response.data]
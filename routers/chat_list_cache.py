@@ -0,0 +1,107 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+
+class ChatListCache(object):
+    """
+    Chat lists of the most recently active users, as sent by /chats
+
+    Every message published on the chat broadcast bus updates the last
+    message preview of its chat in place for every cached user, and a new
+    chat drops the lists of both of its users. With a bus shared by the
+    worker processes this covers messages and chats of every worker. With
+    the in-process bus, lists are reloaded every ttl seconds to pick up
+    the ones of other workers.
+    """
+
+    entries: "OrderedDict[int, Tuple[List[Dict[str, Any]], float]]"
+    # Users whose cached list holds each chat
+    users_by_chat: Dict[int, Set[int]]
+
+    def __init__(self, ttl: float, max_size: int) -> None:
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.users_by_chat = dict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: int) -> Optional[List[Dict[str, Any]]]:
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or time.monotonic() - entry[1] > self.ttl:
+                self.drop(user_id)
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return [dict(chat) for chat in entry[0]]
+
+    def put(self, user_id: int, chats: List[Dict[str, Any]]) -> None:
+        with self.lock:
+            self.drop(user_id)
+            self.entries[user_id] = ([dict(chat) for chat in chats], time.monotonic())
+            for chat in chats:
+                self.users_by_chat.setdefault(chat["id"], set()).add(user_id)
+            while len(self.entries) > self.max_size:
+                self.drop(next(iter(self.entries)))
+
+    def drop(self, user_id: int) -> None:
+        # Expects the lock to be held
+        entry = self.entries.pop(user_id, None)
+        if entry is None:
+            return
+        for chat in entry[0]:
+            users = self.users_by_chat.get(chat["id"])
+            if users is not None:
+                users.discard(user_id)
+                if not users:
+                    del self.users_by_chat[chat["id"]]
+
+    def invalidate_user(self, user_id: int) -> None:
+        with self.lock:
+            self.drop(user_id)
+
+    def message(self, chat_id: int, sender_id: int, text: str, created_at: str) -> None:
+        """
+        Updates the last message preview of a chat in every cached list
+
+        Parameters:
+        - chat_id: The chat.
+        - sender_id: The user who sent the message.
+        - text: The message.
+        - created_at: ISO timestamp of the message.
+        """
+        sent_at = format_message_time(created_at)
+        with self.lock:
+            for user_id in self.users_by_chat.get(chat_id, ()):
+                for chat in self.entries[user_id][0]:
+                    if chat["id"] == chat_id:
+                        chat["last_message"] = "You: " + text if sender_id == user_id else text
+                        chat["time"] = sent_at
+
+    def deliver(self, chat_id: int, frame: Dict[str, Any]) -> None:
+        # Sees every frame published on the chat bus, only new messages and new chats change the lists
+        if "invalidate_users" in frame:
+            for user_id in frame["invalidate_users"]:
+                self.invalidate_user(user_id)
+        elif frame.get("text") is not None and "sender_id" in frame:
+            self.message(chat_id, frame["sender_id"], frame["text"], frame["created_at"])
+
+
+def format_message_time(timestamp: Optional[str]) -> str:
+    return "" if timestamp is None else datetime.fromisoformat(timestamp).strftime("%H:%M")
+
+
+# Lists follow every message when the workers share a broadcast bus, otherwise they expire after CHAT_LIST_TTL
+shared_bus = os.environ.get("BROADCAST_BUS", "memory") != "memory"
+chat_list_cache = ChatListCache(
+    ttl=math.inf if shared_bus else float(os.environ.get("CHAT_LIST_TTL", 30)),
+    max_size=int(os.environ.get("CHAT_LIST_CACHE_SIZE", 1024)),
+)
@@ -1,15 +1,25 @@
-from datetime import datetime
+import logging
+import os
+import anyio.from_thread
 from fastapi import status, APIRouter, Depends, HTTPException, WebSocket, WebSocketDisconnect
 from starlette.websockets import WebSocketState
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 from dependencies import get_current_user
 from models import supabase, Chat, User, UserEntity
+from routers.chat_list_cache import chat_list_cache, format_message_time
 from routers.connection_handler import connection_handler
+from routers.database_executor import run_blocking
+from routers.message_writer import message_writer
 
 
 router = APIRouter(prefix="/chats", tags=["chats"])
 
+logger = logging.getLogger(__name__)
+
+# Number of messages sent when a chat is opened
+chat_history_limit = int(os.environ.get("CHAT_HISTORY_LIMIT", 50))
+
 
 # Define the endpoint for creating a chat
 @router.post("/")
@@ -32,6 +42,18 @@ def create_chat(user_id: int, current_user: User = Depends(get_current_user)):
     }]).execute()
     # Check if the response has data
     if response.data:
+        # Both chat lists are missing the new chat, in this worker and in the others sharing the bus
+        chat_list_cache.invalidate_user(current_user.id)
+        chat_list_cache.invalidate_user(user_id)
+        try:
+            anyio.from_thread.run(
+                connection_handler.broadcast,
+                response.data[0]["id"],
+                {"invalidate_users": [current_user.id, user_id]}
+            )
+        except Exception as e:
+            # Other workers reload the lists after CHAT_LIST_TTL
+            logger.warning("Couldn't announce chat %s: %s", response.data[0]["id"], e)
         # Return the chat id
         return {"chat_id": response.data[0]["id"]}
     else:
@@ -48,7 +70,7 @@ def supabase_chat_to_response(current_user: User, chat: Dict[str, Any]) -> Dict[
     if last_message_sender_id == current_user.id:
         last_message = "You: " + last_message
 
-    last_message_time = "" if chat["ts"] is None else datetime.fromisoformat(chat["ts"]).strftime("%H:%M")
+    last_message_time = format_message_time(chat["ts"])
 
     return {
         "id": chat["id"],
@@ -62,16 +84,55 @@ def supabase_chat_to_response(current_user: User, chat: Dict[str, Any]) -> Dict[
 # Define the endpoint for listing chats
 @router.get("/")
 def list_chats(current_user: User = Depends(get_current_user)):
+    chats = chat_list_cache.get(current_user.id)
+    if chats is not None:
+        return chats
+
     response = supabase.rpc("get_chats", {"caller_id": current_user.id}).execute()
 
     if not response:
         return []
 
-    return [supabase_chat_to_response(current_user, chat) for chat in response.data]
+    chats = [supabase_chat_to_response(current_user, chat) for chat in response.data]
+    chat_list_cache.put(current_user.id, chats)
+    return chats
+
+
+def load_messages(chat_id: int, limit: Optional[int] = None, before: Optional[int] = None) -> Dict[str, Any]:
+    # Newest messages first so that the last N can be limited, then back to chronological order
+    query = supabase.table("messages").select("*").eq("chat_id", chat_id)
+    if before is not None:
+        query = query.lt("id", before)
+    if limit is None:
+        return {"data": query.order("id").execute().data, "before": None}
+    messages = query.order("id", desc=True).limit(limit).execute().data[::-1]
+    # Cursor for the previous page, None once the beginning of the chat is reached
+    cursor = messages[0]["id"] if messages and len(messages) == limit else None
+    return {"data": messages, "before": cursor}
 
 
 @router.get("/history/{chat_id}")
-def get_chat_history(chat_id: int, current_user: User = Depends(get_current_user)):
+def get_chat_history(
+        chat_id: int,
+        current_user: User = Depends(get_current_user),
+        limit: Optional[int] = None,
+        before: Optional[int] = None
+):
+    """
+    Lists the messages of a chat
+
+    Parameters:
+    - token (str): The user token.
+    - limit (int): Only the last N messages, all of them if not set.
+    - before (int): Only messages older than this message id, to page backwards.
+
+    Returns:
+    {
+        "name": str,
+        "data": list[dict],
+        "before": int | None
+    }
+    """
     response = supabase.table("chats").select("*").eq("id", chat_id).execute()
     if response.data:
         # Get the chat as a Chat object
@@ -87,8 +148,7 @@ def get_chat_history(chat_id: int, current_user: User = Depends(get_current_user
                 detail="User is not authorised to access the chat",
             )
         full_name = f'{response.data[0]["first_name"]} {response.data[0]["last_name"]}'
-        response = supabase.table("messages").select("*").eq("chat_id", chat_id).execute()
-        return {"name": full_name, "data": response.data}
+        return {"name": full_name, **load_messages(chat_id, limit, before)}
     else:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -121,14 +181,30 @@ def list_users(current_user: User = Depends(get_current_user), query: str = "",
     return {"users": users}
 
 
+# Send queue depths and latencies of the open chat sockets
+@router.get("/metrics")
+def get_chat_metrics(current_user: User = Depends(get_current_user)):
+    if current_user.entity != UserEntity.manager:
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only parcel operators can get chat metrics",
+        )
+    return connection_handler.metrics()
+
+
 # Define the websocket endpoint for opening a chat
 @router.websocket("/{chat_id}")
-async def open_chat(websocket: WebSocket, chat_id: int, current_user: User = Depends(get_current_user)):
+async def open_chat(
+        websocket: WebSocket,
+        chat_id: int,
+        current_user: User = Depends(get_current_user),
+        history_limit: int = chat_history_limit
+):
     print("entered")
     # Accept the websocket connection
     await websocket.accept()
     # Query the chat table with the chat id
-    response = supabase.table("chats").select("*").eq("id", chat_id).execute()
+    response = await run_blocking(supabase.table("chats").select("*").eq("id", chat_id).execute)
     print(response)
     # Check if the response has data
     if response.data:
@@ -138,10 +214,12 @@ async def open_chat(websocket: WebSocket, chat_id: int, current_user: User = Dep
         print(current_user.id, chat)
         if current_user.id in [chat.driver_id, chat.user_id]:
             print(f"user {current_user.id} entered the chat")
-            connection_handler.register(chat_id, current_user.id, websocket)
-            existing_messages = supabase.table("messages").select("*").eq("chat_id", chat_id).execute()
-            for message in existing_messages.data:
-                await websocket.send_json(message)
+            connection = await connection_handler.register(chat_id, current_user.id, websocket)
+            message_writer.start(connection_handler.broadcast)
+            # The last messages go out in one frame, older ones are paged through /chats/history.
+            # Queued like every other frame so broadcasts can't overtake the history.
+            existing_messages = await run_blocking(load_messages, chat_id, history_limit)
+            connection.offer({"history": existing_messages["data"], "before": existing_messages["before"]})
             # Receive messages from the websocket
             while True:
                 # Try to receive a message
@@ -150,18 +228,14 @@ async def open_chat(websocket: WebSocket, chat_id: int, current_user: User = Dep
                     print(f"received {text} from {current_user.id}")
                 # Close the websocket if the connection is closed
                 except WebSocketDisconnect:
+                    connection_handler.close(chat_id, current_user.id, connection)
                     if websocket.client_state != WebSocketState.DISCONNECTED:
                         await websocket.close()
-                        connection_handler.close(chat_id, current_user.id)
                     break
-                # Append the message to the chat messages
-                response = supabase.table("messages").insert({
-                    "chat_id": chat_id,
-                    "sender_id": current_user.id,
-                    "text": text
-                }).execute()
-                # Broadcast the message to the socket users
-                await connection_handler.broadcast(chat_id, response.data[0])
+                # Queue the message for the next batch insert, its stored id is broadcast once it is written
+                message = message_writer.write(chat_id, current_user.id, text)
+                # Broadcast the message to the socket users, which also updates the chat lists of every worker
+                await connection_handler.broadcast(chat_id, message)
         else:
             # Close the websocket if the current user is not authorized
             if websocket.client_state != WebSocketState.DISCONNECTED:
@@ -1,27 +1,168 @@
+import asyncio
+import logging
+import os
+import time
 from fastapi import WebSocket
-from typing import Dict
+from typing import Any, Callable, Dict, Optional
 
 from models import Message
+from routers.broadcast_bus import BroadcastBus, Deliver, create_broadcast_bus
+from routers.chat_list_cache import chat_list_cache
+
+
+logger = logging.getLogger(__name__)
+
+
+class Connection(object):
+    """
+    Websocket with a bounded send queue drained by its own writer task
+
+    A slow client only fills its own queue. When the queue is full the slow
+    consumer policy either drops the oldest queued message ("drop_oldest")
+    or disconnects the client ("disconnect").
+    """
+
+    def __init__(
+            self,
+            websocket: WebSocket,
+            max_queue_size: int,
+            send_timeout: float,
+            slow_consumer_policy: str,
+            on_closed: Callable[["Connection", bool], None]
+    ) -> None:
+        self.websocket = websocket
+        self.queue = asyncio.Queue(maxsize=max_queue_size)
+        self.send_timeout = send_timeout
+        self.slow_consumer_policy = slow_consumer_policy
+        self.on_closed = on_closed
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+        self.send_seconds = 0.0
+        self.max_send_seconds = 0.0
+        self.writer = asyncio.create_task(self.write())
+
+    async def write(self) -> None:
+        while True:
+            message = await self.queue.get()
+            start = time.perf_counter()
+            try:
+                await asyncio.wait_for(self.websocket.send_json(message), self.send_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.info("Dropping dead websocket: %s", e)
+                await self.close()
+                return
+            elapsed = time.perf_counter() - start
+            self.sent += 1
+            self.send_seconds += elapsed
+            self.max_send_seconds = max(self.max_send_seconds, elapsed)
+
+    def offer(self, message: Any) -> None:
+        if self.closed:
+            return
+        if self.queue.full():
+            if self.slow_consumer_policy == "disconnect":
+                logger.info("Disconnecting slow websocket with %s queued messages", self.queue.qsize())
+                asyncio.create_task(self.close(slow=True))
+                return
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(message)
+
+    async def close(self, slow: bool = False) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        self.on_closed(self, slow)
+        if asyncio.current_task() is not self.writer:
+            self.writer.cancel()
+        try:
+            await self.websocket.close()
+        except Exception:
+            # Already closed by the client
+            pass
 
 
 class ConnectionHandler(object):
 
-    active_sockets: Dict[int, Dict[int, WebSocket]]
+    active_sockets: Dict[int, Dict[int, Connection]]
 
-    def __init__(self) -> None:
+    def __init__(
+            self,
+            bus: BroadcastBus,
+            max_queue_size: int,
+            send_timeout: float,
+            slow_consumer_policy: str,
+            on_deliver: Optional[Deliver] = None
+    ) -> None:
         self.active_sockets = dict()
+        self.bus = bus
+        # Also sees every message of the bus, whether or not this process serves sockets of its chat
+        self.on_deliver = on_deliver
+        self.max_queue_size = max_queue_size
+        self.send_timeout = send_timeout
+        self.slow_consumer_policy = slow_consumer_policy
+        self.disconnected = 0
 
-    def register(self, chat_id: int, user_id: int, websocket: WebSocket) -> None:
+    async def register(self, chat_id: int, user_id: int, websocket: WebSocket) -> Connection:
+        # Processes only listen to the bus once they serve a socket
+        await self.bus.start(self.deliver)
         self.active_sockets.setdefault(chat_id, dict())
-        self.active_sockets[chat_id][user_id] = websocket
+        previous = self.active_sockets[chat_id].get(user_id)
+        if previous is not None:
+            previous.closed = True
+            previous.writer.cancel()
+
+        def on_closed(connection: Connection, slow: bool) -> None:
+            if self.active_sockets.get(chat_id, dict()).get(user_id) is connection:
+                del self.active_sockets[chat_id][user_id]
+            if slow:
+                self.disconnected += 1
+
+        connection = Connection(websocket, self.max_queue_size, self.send_timeout, self.slow_consumer_policy, on_closed)
+        self.active_sockets[chat_id][user_id] = connection
+        return connection
 
     async def broadcast(self, chat_id: int, message: Message) -> None:
-        for websocket in self.active_sockets[chat_id].values():
-            await websocket.send_json(message)
+        # Reaches the sockets of the chat in every process sharing the bus
+        await self.bus.publish(chat_id, message)
 
-    def close(self, chat_id: int, user_id: int) -> None:
-        self.active_sockets.setdefault(chat_id, dict())
-        self.active_sockets[chat_id].pop(user_id, None)
+    def deliver(self, chat_id: int, message: Message) -> None:
+        if self.on_deliver is not None:
+            self.on_deliver(chat_id, message)
+        # Only enqueues, every connection is written concurrently by its own writer task
+        for connection in list(self.active_sockets.get(chat_id, dict()).values()):
+            connection.offer(message)
+
+    def close(self, chat_id: int, user_id: int, connection: Connection) -> None:
+        # A reconnect may have registered a newer connection of the user already, which stays
+        connection.closed = True
+        connection.writer.cancel()
+        sockets = self.active_sockets.get(chat_id, dict())
+        if sockets.get(user_id) is connection:
+            del sockets[user_id]
+
+    def metrics(self) -> Dict[str, Any]:
+        connections = [connection for sockets in self.active_sockets.values() for connection in sockets.values()]
+        sent = sum(connection.sent for connection in connections)
+        send_seconds = sum(connection.send_seconds for connection in connections)
+        return {
+            "connections": len(connections),
+            "queued_messages": sum(connection.queue.qsize() for connection in connections),
+            "max_queue_depth": max((connection.queue.qsize() for connection in connections), default=0),
+            "dropped_messages": sum(connection.dropped for connection in connections),
+            "disconnected_slow_consumers": self.disconnected,
+            "average_send_ms": round(1000 * send_seconds / sent, 3) if sent else 0.0,
+            "max_send_ms": round(1000 * max((c.max_send_seconds for c in connections), default=0.0), 3),
+        }
 
 
-connection_handler = ConnectionHandler()
+connection_handler = ConnectionHandler(
+    bus=create_broadcast_bus(os.environ.get("BROADCAST_BUS", "memory"), os.environ, "chats"),
+    max_queue_size=int(os.environ.get("CHAT_SEND_QUEUE_SIZE", 100)),
+    send_timeout=float(os.environ.get("CHAT_SEND_TIMEOUT", 10)),
+    slow_consumer_policy=os.environ.get("CHAT_SLOW_CONSUMER_POLICY", "drop_oldest"),
+    on_deliver=chat_list_cache.deliver,
+)
@@ -0,0 +1,20 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, TypeVar
+
+
+T = TypeVar("T")
+
+# The Supabase client is synchronous, async handlers run its round trips on these threads
+# so that one slow query doesn't stall every websocket served by the event loop
+database_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("DATABASE_THREADS", 16)),
+    thread_name_prefix="database",
+)
+
+
+async def run_blocking(function: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(database_executor, functools.partial(function, *args, **kwargs))
@@ -0,0 +1,43 @@
+from typing import Iterable
+
+from routers.lazy_import import lazy_import
+
+np = lazy_import("numpy")
+shapely = lazy_import("shapely")
+
+
+def decode_points(locations: Iterable[str]) -> "np.ndarray":
+    """
+    Decodes hex-encoded WKB points in one vectorized call
+
+    Parameters:
+    - locations: Hex WKB strings as stored in the location column.
+
+    Returns:
+    Contiguous (n, 2) float64 array of (long, lat) pairs.
+    """
+    geometries = shapely.from_wkb(np.asarray(list(locations), dtype=object))
+    return np.ascontiguousarray(shapely.get_coordinates(geometries), dtype=np.float64)
+
+
+EARTH_RADIUS_METERS = 6371000.0
+
+
+def haversine_meters(origins, destinations) -> "np.ndarray":
+    """
+    Computes great-circle distances between every origin and every destination
+
+    Parameters:
+    - origins: (n, 2) array of (long, lat) pairs.
+    - destinations: (m, 2) array of (long, lat) pairs.
+
+    Returns:
+    (n, m) array of distances in meters.
+    """
+    origins = np.radians(np.asarray(origins, dtype=np.float64).reshape(-1, 2))
+    destinations = np.radians(np.asarray(destinations, dtype=np.float64).reshape(-1, 2))
+    long_from, lat_from = origins[:, 0][:, None], origins[:, 1][:, None]
+    long_to, lat_to = destinations[:, 0][None, :], destinations[:, 1][None, :]
+    a = np.sin((lat_to - lat_from) / 2) ** 2 \
+        + np.cos(lat_from) * np.cos(lat_to) * np.sin((long_to - long_from) / 2) ** 2
+    return 2 * EARTH_RADIUS_METERS * np.arcsin(np.sqrt(a))
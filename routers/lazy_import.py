@@ -0,0 +1,48 @@
+import importlib
+import sys
+import threading
+from types import ModuleType
+
+
+class LazyModule(ModuleType):
+    """
+    Stands in for a module until one of its attributes is read
+
+    The first read imports the module under a lock, so threads of the
+    request pool that need it at the same time all wait for the same import
+    instead of seeing a half initialised module.
+    """
+
+    def __init__(self, name: str) -> None:
+        super().__init__(name)
+        self.lazy_lock = threading.Lock()
+        self.lazy_module = None
+
+    def __getattr__(self, attribute: str):
+        # Only called for attributes missing from the stand-in, which are all the ones of the module
+        module = self.lazy_module
+        if module is None:
+            with self.lazy_lock:
+                if self.lazy_module is None:
+                    self.lazy_module = importlib.import_module(self.__name__)
+                module = self.lazy_module
+        return getattr(module, attribute)
+
+
+def lazy_import(name: str) -> ModuleType:
+    """
+    Imports a module on first attribute access instead of right away
+
+    Keeps heavy dependencies out of the start of the API process until a
+    request actually needs them. Annotations that mention the module have
+    to be strings, since they are evaluated when the function is defined.
+
+    Parameters:
+    - name: Absolute name of the module.
+
+    Returns:
+    The module if something else imported it before, a stand-in for it otherwise.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return LazyModule(name)
@@ -0,0 +1,57 @@
+import bisect
+import logging
+import os
+import threading
+import time
+from typing import Dict, Iterable, List
+
+from routers.stop_loader import load_bus_stop_mappings
+
+
+logger = logging.getLogger(__name__)
+
+
+class StopLineIndex(object):
+    """
+    Bus lines serving every stop by ascending bus id, loaded from bus_stop_mappings
+
+    Mappings created by this worker are added as they happen, the whole index
+    is reloaded every ttl seconds to pick up changes made by other workers.
+    """
+
+    bus_ids_by_stop: Dict[int, List[int]]
+
+    def __init__(self, ttl: float) -> None:
+        self.ttl = ttl
+        self.bus_ids_by_stop = dict()
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def refresh(self) -> None:
+        with self.lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl:
+                return
+            bus_ids_by_stop = dict()
+            for mapping in load_bus_stop_mappings():
+                bus_ids_by_stop.setdefault(mapping["stop_id"], []).append(mapping["bus_id"])
+            self.bus_ids_by_stop = bus_ids_by_stop
+            self.loaded_at = time.monotonic()
+            logger.info("Indexed bus lines of %s stops", len(bus_ids_by_stop))
+
+    def add(self, stop_id: int, bus_id: int) -> None:
+        with self.lock:
+            bus_ids = self.bus_ids_by_stop.setdefault(stop_id, [])
+            if bus_id not in bus_ids:
+                # Same order as after a reload, which reads the mappings ordered by bus_id
+                bisect.insort(bus_ids, bus_id)
+
+    def lookup(self, stop_ids: Iterable[int]) -> Dict[int, List[int]]:
+        self.refresh()
+        return {stop_id: self.bus_ids_by_stop.get(stop_id, []) for stop_id in stop_ids}
+
+    def bus_ids(self) -> List[int]:
+        self.refresh()
+        return sorted({bus_id for bus_ids in self.bus_ids_by_stop.values() for bus_id in bus_ids})
+
+
+stop_line_index = StopLineIndex(ttl=float(os.environ.get("LINE_INDEX_TTL", 300)))
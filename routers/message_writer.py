@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from models import supabase
+from routers.database_executor import run_blocking
+
+
+logger = logging.getLogger(__name__)
+
+# Receives the chat id and the frame to send to its sockets
+Publish = Callable[[int, Dict[str, Any]], Awaitable[None]]
+
+
+class MessageWriter(object):
+    """
+    Write-behind persistence of chat messages
+
+    Messages are broadcast right away with "id" set to None and a
+    "provisional_id", then inserted together with the messages of every other
+    chat in batches of at most max_batch_size, at most max_delay seconds after
+    the first of them was received. Once a batch is stored, a frame
+    {"provisional_id": ..., "message": ...} with the stored row is sent to the
+    chat so clients can swap the provisional message for it. A batch that
+    can't be stored after max_attempts is reported with
+    {"provisional_id": ..., "failed": True} instead.
+    """
+
+    pending: List[Dict[str, Any]]
+
+    def __init__(self, max_batch_size: int, max_delay: float, max_attempts: int) -> None:
+        self.max_batch_size = max_batch_size
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.pending = []
+        self.publish: Optional[Publish] = None
+        self.flusher: Optional[asyncio.Task] = None
+        self.wakeup: Optional[asyncio.Event] = None
+        self.closed = False
+        self.batches = 0
+        self.written = 0
+
+    def start(self, publish: Publish) -> None:
+        # Also replaces a flusher that died, the new one picks up the pending messages
+        if self.flusher is not None and not self.flusher.done():
+            return
+        if self.flusher is not None and not self.flusher.cancelled() and self.flusher.exception() is not None:
+            logger.error("Restarting chat message flusher that failed: %s", self.flusher.exception())
+        self.publish = publish
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        self.flusher = asyncio.create_task(self.run())
+        if self.pending:
+            self.wakeup.set()
+
+    def write(self, chat_id: int, sender_id: int, text: str) -> Dict[str, Any]:
+        """
+        Queues a message for insertion
+
+        Parameters:
+        - chat_id: The chat.
+        - sender_id: The user who sent the message.
+        - text: The message.
+
+        Returns:
+        The provisional message to broadcast.
+        """
+        message = {
+            "id": None,
+            "provisional_id": uuid.uuid4().hex,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "chat_id": chat_id,
+            "sender_id": sender_id,
+            "text": text,
+        }
+        self.pending.append({"message": message, "attempts": 0})
+        self.wakeup.set()
+        return message
+
+    async def run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while not self.closed or self.pending:
+            await self.wakeup.wait()
+            # The batch closes max_delay after its first message, or earlier once it is full
+            deadline = loop.time() + self.max_delay
+            while not self.closed and len(self.pending) < self.max_batch_size and loop.time() < deadline:
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), deadline - loop.time())
+                except asyncio.TimeoutError:
+                    break
+            self.wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                # Keeps flushing later batches, the messages of this one are not retried
+                logger.exception("Couldn't flush chat messages")
+
+    async def flush(self) -> None:
+        while self.pending:
+            batch, self.pending = self.pending[:self.max_batch_size], self.pending[self.max_batch_size:]
+            rows = [
+                {key: entry["message"][key] for key in ("chat_id", "sender_id", "text")}
+                for entry in batch
+            ]
+            try:
+                stored = (await run_blocking(supabase.table("messages").insert(rows).execute)).data
+            except Exception as e:
+                logger.warning("Couldn't store %s chat messages: %s", len(batch), e)
+                await self.retry(batch)
+                return
+            self.batches += 1
+            self.written += len(stored)
+            # Rows of a bulk insert come back in the order they were sent
+            for entry, message in zip(batch, stored):
+                provisional_id = entry["message"]["provisional_id"]
+                await self.publish(message["chat_id"], {"provisional_id": provisional_id, "message": message})
+
+    async def retry(self, batch: List[Dict[str, Any]]) -> None:
+        retried = []
+        for entry in batch:
+            entry["attempts"] += 1
+            if entry["attempts"] < self.max_attempts:
+                retried.append(entry)
+            else:
+                message = entry["message"]
+                await self.publish(message["chat_id"], {"provisional_id": message["provisional_id"], "failed": True})
+        # Retried messages keep their place in front of the newer ones
+        self.pending = retried + self.pending
+        await asyncio.sleep(self.max_delay)
+        self.wakeup.set()
+
+    async def close(self) -> None:
+        # Stores what is still pending, giving every message its remaining attempts
+        self.closed = True
+        if self.flusher is not None:
+            self.wakeup.set()
+            await self.flusher
+
+
+message_writer = MessageWriter(
+    max_batch_size=int(os.environ.get("MESSAGE_BATCH_SIZE", 50)),
+    max_delay=float(os.environ.get("MESSAGE_BATCH_DELAY", 0.05)),
+    max_attempts=int(os.environ.get("MESSAGE_WRITE_ATTEMPTS", 3)),
+)
@@ -0,0 +1,51 @@
+import logging
+import os
+from typing import Any, Dict
+
+import anyio.from_thread
+
+from routers.broadcast_bus import create_broadcast_bus
+from routers.connection_handler import ConnectionHandler
+
+
+logger = logging.getLogger(__name__)
+
+# Channel of the manager feed, every other channel is the id of a bus line
+ALL_BUSES = -1
+
+# Sockets subscribed to bus positions, on a bus of their own so chat and bus ids never mix
+position_handler = ConnectionHandler(
+    bus=create_broadcast_bus(os.environ.get("BROADCAST_BUS", "memory"), os.environ, "positions"),
+    max_queue_size=int(os.environ.get("POSITION_SEND_QUEUE_SIZE", 20)),
+    send_timeout=float(os.environ.get("CHAT_SEND_TIMEOUT", 10)),
+    slow_consumer_policy="drop_oldest",
+)
+
+
+async def broadcast_position(event: Dict[str, Any]) -> None:
+    await position_handler.broadcast(event["bus_id"], event)
+    await position_handler.broadcast(ALL_BUSES, event)
+
+
+async def publish_position_async(event: Dict[str, Any]) -> None:
+    # Same as publish_position, for handlers running on the event loop
+    try:
+        await broadcast_position(event)
+    except Exception as e:
+        logger.warning("Couldn't publish position of bus %s: %s", event["bus_id"], e)
+
+
+def publish_position(event: Dict[str, Any]) -> None:
+    """
+    Sends a bus position event to the subscribers of its line and to the manager feed
+
+    Meant for the synchronous endpoints, which run in worker threads of the event loop.
+
+    Parameters:
+    - event: Event with at least the bus_id.
+    """
+    try:
+        anyio.from_thread.run(broadcast_position, event)
+    except Exception as e:
+        # Subscribers catch up from the snapshot sent when they reconnect
+        logger.warning("Couldn't publish position of bus %s: %s", event["bus_id"], e)
@@ -0,0 +1,169 @@
+import time
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from models import StopEntity
+
+
+class Route(object):
+    """
+    Bus line route that is travelled back and forth
+
+    Stops keep the order of the solved route for the whole life of the route.
+    A bus is at a cursor made of a position in that order and a direction
+    (True towards the end of the route). Served dynamic stops are not removed
+    but marked inactive, so positions never shift while the bus is driving.
+    Active positions are doubly linked, so moving the cursor and serving a
+    stop take constant time however many stops were served before.
+    """
+
+    stops: List[Dict[str, Any]]
+    active: List[bool]
+    # Nearest active position after and before every position, -1 past the ends
+    following: List[int]
+    preceding: List[int]
+
+    def __init__(
+            self,
+            stops: List[Dict[str, Any]],
+            active: Optional[List[bool]] = None,
+            size: Optional[int] = None,
+            solved_at: Optional[float] = None,
+            insertions: int = 0,
+            following: Optional[List[int]] = None,
+            preceding: Optional[List[int]] = None
+    ) -> None:
+        self.stops = stops
+        self.active = [True] * len(stops) if active is None else active
+        if following is None or preceding is None:
+            self.link()
+        else:
+            self.following = following
+            self.preceding = preceding
+        # Size, time and number of insertions since the last full solve
+        self.size = len(stops) if size is None else size
+        self.solved_at = time.time() if solved_at is None else solved_at
+        self.insertions = insertions
+
+    @classmethod
+    def from_dict(cls, route: Dict[str, Any]) -> "Route":
+        return cls(**route)
+
+    def copy(self) -> "Route":
+        # Stops are never changed in place, so copying the lists that hold them is enough
+        return Route(
+            list(self.stops),
+            list(self.active),
+            self.size,
+            self.solved_at,
+            self.insertions,
+            list(self.following),
+            list(self.preceding)
+        )
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "stops": self.stops,
+            "active": self.active,
+            "size": self.size,
+            "solved_at": self.solved_at,
+            "insertions": self.insertions,
+            "following": self.following,
+            "preceding": self.preceding,
+        }
+
+    def link(self) -> None:
+        n = len(self.stops)
+        self.following = [-1] * n
+        self.preceding = [-1] * n
+        last = -1
+        for position in range(n):
+            self.preceding[position] = last
+            if self.active[position]:
+                last = position
+        last = -1
+        for position in reversed(range(n)):
+            self.following[position] = last
+            if self.active[position]:
+                last = position
+
+    def is_dynamic(self, position: int) -> bool:
+        return self.stops[position]["entity"] != StopEntity.static.value
+
+    def find(self, stop_id: int) -> Optional[int]:
+        for position, stop in enumerate(self.stops):
+            if stop.get("stop_id") == stop_id:
+                return position
+        return None
+
+    def listed_stops(self) -> List[Dict[str, Any]]:
+        # In route order, so that buses.stop_number indexes into it, served stops flagged inactive
+        return [{**stop, "is_active": active} for stop, active in zip(self.stops, self.active)]
+
+    def nearest_active(self, position: int, direction: bool, consumed: Set[int]) -> Optional[int]:
+        links = self.following if direction else self.preceding
+        position = links[position]
+        # Links of served positions may point at stops served after them
+        while position != -1 and (not self.active[position] or position in consumed):
+            position = links[position]
+        return None if position == -1 else position
+
+    def step(self, position: int, direction: bool, consumed: Set[int] = frozenset()) -> Tuple[int, bool]:
+        """
+        Moves the cursor to the next active stop, turning around at the ends of the route
+
+        Parameters:
+        - position: Current position.
+        - direction: Current direction.
+        - consumed: Positions to treat as inactive on top of the served stops.
+
+        Returns:
+        The next position and direction.
+        """
+        following = self.nearest_active(position, direction, consumed)
+        if following is not None:
+            return following, direction
+        following = self.nearest_active(position, not direction, consumed)
+        if following is not None:
+            return following, not direction
+        return position, direction
+
+    def consume(self, position: int) -> None:
+        if not self.active[position]:
+            return
+        self.active[position] = False
+        following, preceding = self.following[position], self.preceding[position]
+        if preceding != -1:
+            self.following[preceding] = following
+        if following != -1:
+            self.preceding[following] = preceding
+
+    def insert(self, position: int, stop: Dict[str, Any]) -> None:
+        # Shifts the positions after the new stop, which is rare compared to driving
+        self.stops.insert(position, stop)
+        self.active.insert(position, True)
+        self.insertions += 1
+        self.link()
+
+    def next_stops(self, position: int, direction: bool, count: int) -> List[Dict[str, Any]]:
+        """
+        Lists the stop at the cursor and the next stops the bus will serve
+
+        Dynamic stops are served once, so the walk remembers the ones it passed
+        instead of copying the route.
+
+        Parameters:
+        - position: Current position.
+        - direction: Current direction.
+        - count: Number of next stops.
+
+        Returns:
+        count + 1 stops, starting with the current one.
+        """
+        consumed = set()
+        stops = [self.stops[position]]
+        for _ in range(count):
+            if self.is_dynamic(position):
+                consumed.add(position)
+            position, direction = self.step(position, direction, consumed)
+            stops.append(self.stops[position])
+        return stops
@@ -0,0 +1,81 @@
+import asyncio
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import Any, Callable, Dict, Tuple
+
+from fastapi import HTTPException
+
+
+logger = logging.getLogger(__name__)
+
+
+def run_route_task(compute: Callable[[int], Dict[str, Any]], bus_id: int) -> Tuple[bool, Any]:
+    # HTTPException can't be pickled back from a worker process, send its fields instead
+    try:
+        return True, compute(bus_id)
+    except HTTPException as e:
+        return False, (e.status_code, e.detail)
+
+
+class RouteService(object):
+
+    in_flight: Dict[int, Future]
+
+    def __init__(self, compute: Callable[[int], Dict[str, Any]], max_workers: int) -> None:
+        self.compute_route = compute
+        self.max_workers = max_workers
+        self.executor = None
+        self.in_flight = dict()
+        self.lock = threading.Lock()
+
+    def get_executor(self) -> ProcessPoolExecutor:
+        # Workers are spawned on first use so that importing the module stays cheap
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return self.executor
+
+    def submit(self, bus_id: int, fresh: bool = False) -> Future:
+        # Concurrent requests for the same bus line share one computation. A fresh one never joins
+        # a running computation, which may have read the stops of the line before they changed.
+        with self.lock:
+            future = self.in_flight.get(bus_id)
+            if future is not None and not fresh:
+                return future
+            task = self.get_executor().submit(run_route_task, self.compute_route, bus_id)
+            future = Future()
+            self.in_flight[bus_id] = future
+
+        def resolve(done: Future) -> None:
+            with self.lock:
+                # Later requests may already share a fresh computation
+                if self.in_flight.get(bus_id) is future:
+                    del self.in_flight[bus_id]
+            try:
+                succeeded, result = done.result()
+            except Exception as e:
+                future.set_exception(e)
+                return
+            if succeeded:
+                future.set_result(result)
+            else:
+                status_code, detail = result
+                future.set_exception(HTTPException(status_code=status_code, detail=detail))
+
+        task.add_done_callback(resolve)
+        return future
+
+    def compute(self, bus_id: int, fresh: bool = False) -> Dict[str, Any]:
+        return self.submit(bus_id, fresh).result()
+
+    async def compute_async(self, bus_id: int) -> Dict[str, Any]:
+        return await asyncio.wrap_future(self.submit(bus_id))
+
+    def shutdown(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
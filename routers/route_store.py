@@ -0,0 +1,277 @@
+import json
+import sqlite3
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from routers.route import Route
+
+
+# Every successful write bumps the version of a route by one. Version 0 stands for a route
+# that is not stored. Deleting a route keeps its version in a tombstone, so a route that is
+# computed again never reuses the version of an old one.
+RouteEntry = Tuple[Optional[Route], int]
+
+
+class RouteStore(object):
+
+    def get(self, bus_id: int) -> Optional[RouteEntry]:
+        """
+        Reads a route
+
+        Parameters:
+        - bus_id: The bus line.
+
+        Returns:
+        The route and its version, None if the route is not stored. The route may be shared
+        with other readers, copy it before changing it.
+        """
+        raise NotImplementedError
+
+    def version(self, bus_id: int) -> int:
+        # Cheaper than get, enough to look up results cached for a version
+        raise NotImplementedError
+
+    def compare_and_set(self, bus_id: int, route: Route, expected_version: int) -> int:
+        """
+        Writes a route unless somebody else wrote it since it was read
+
+        Parameters:
+        - bus_id: The bus line.
+        - route: The new route, which must not be changed once it is written.
+        - expected_version: Version the route was read at, 0 to only create it.
+
+        Returns:
+        The new version, 0 if the route was not written.
+        """
+        raise NotImplementedError
+
+    def consume(self, bus_id: int, position: int, expected_version: int) -> int:
+        """
+        Marks a stop of a route as served without writing the rest of the route
+
+        Parameters:
+        - bus_id: The bus line.
+        - position: Position of the served stop.
+        - expected_version: Version the route was read at.
+
+        Returns:
+        The new version, 0 if the route was written since it was read.
+        """
+        raise NotImplementedError
+
+    def delete(self, bus_id: int) -> None:
+        # Leaves a tombstone with a newer version, which makes pending writes of the old route fail
+        raise NotImplementedError
+
+    def bus_ids(self) -> List[int]:
+        raise NotImplementedError
+
+
+class InProcessRouteStore(RouteStore):
+
+    routes: Dict[int, RouteEntry]
+
+    def __init__(self) -> None:
+        self.routes = dict()
+        self.lock = threading.Lock()
+
+    def get(self, bus_id):
+        with self.lock:
+            entry = self.routes.get(bus_id)
+            if entry is None or entry[0] is None:
+                return None
+            return entry
+
+    def version(self, bus_id):
+        with self.lock:
+            entry = self.routes.get(bus_id)
+            return 0 if entry is None or entry[0] is None else entry[1]
+
+    def compare_and_set(self, bus_id, route, expected_version):
+        with self.lock:
+            entry = self.routes.get(bus_id)
+            # A tombstone only accepts creating the route again
+            stored_version = 0 if entry is None or entry[0] is None else entry[1]
+            if stored_version != expected_version:
+                return 0
+            version = 0 if entry is None else entry[1]
+            self.routes[bus_id] = (route, version + 1)
+            return version + 1
+
+    def consume(self, bus_id, position, expected_version):
+        with self.lock:
+            entry = self.routes.get(bus_id)
+            if entry is None or entry[0] is None or entry[1] != expected_version:
+                return 0
+            # Changed in place, walks of readers skip stops that are no longer active
+            entry[0].consume(position)
+            self.routes[bus_id] = (entry[0], expected_version + 1)
+            return expected_version + 1
+
+    def delete(self, bus_id):
+        with self.lock:
+            entry = self.routes.get(bus_id)
+            if entry is not None:
+                self.routes[bus_id] = (None, entry[1] + 1)
+
+    def bus_ids(self):
+        with self.lock:
+            return [bus_id for bus_id, entry in self.routes.items() if entry[0] is not None]
+
+
+class SqliteRouteStore(RouteStore):
+    """
+    Routes shared by every worker process on the host through one database file
+
+    Routes are written whole only when they are solved or a stop is inserted.
+    Serving a stop adds a row to served_stops instead, numbered with the
+    version it created, and full writes clear those rows. Every process keeps
+    the routes it read, and catches up with the stops served by others since
+    then unless the route was written whole in the meantime. Tombstones are
+    rows whose route is the JSON null.
+    """
+
+    routes: Dict[int, RouteEntry]
+
+    def __init__(self, path: str) -> None:
+        self.lock = threading.Lock()
+        self.routes = dict()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS routes ("
+            "bus_id INTEGER PRIMARY KEY, "
+            "version INTEGER NOT NULL, "
+            "route TEXT NOT NULL)"
+        )
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS served_stops ("
+            "bus_id INTEGER NOT NULL, "
+            "version INTEGER NOT NULL, "
+            "position INTEGER NOT NULL, "
+            "PRIMARY KEY (bus_id, version))"
+        )
+
+    def get(self, bus_id):
+        with self.lock:
+            version = self.read_version(bus_id)
+            if not version:
+                self.routes.pop(bus_id, None)
+                return None
+            entry = self.routes.get(bus_id)
+            if entry is None or entry[1] != version:
+                entry = self.catch_up(bus_id, entry) or self.load(bus_id)
+            if entry is None:
+                # Deleted since its version was read
+                self.routes.pop(bus_id, None)
+                return None
+            self.routes[bus_id] = entry
+            return entry
+
+    def catch_up(self, bus_id: int, entry: Optional[RouteEntry]) -> Optional[RouteEntry]:
+        # Applies the stops served since the route was read, None if it was written whole since
+        if entry is None:
+            return None
+        route, version = entry
+        served = self.connection.execute(
+            "SELECT version, position FROM served_stops WHERE bus_id = ? AND version > ? ORDER BY version",
+            (bus_id, version)
+        ).fetchall()
+        if not served or [row[0] for row in served] != list(range(version + 1, version + 1 + len(served))):
+            return None
+        for _, position in served:
+            route.consume(position)
+        return route, served[-1][0]
+
+    def load(self, bus_id: int) -> Optional[RouteEntry]:
+        # One read transaction, so the served stops match the route
+        self.connection.execute("BEGIN")
+        with self.connection:
+            row = self.connection.execute("SELECT route, version FROM routes WHERE bus_id = ?", (bus_id,)).fetchone()
+            served = self.connection.execute("SELECT position FROM served_stops WHERE bus_id = ?", (bus_id,)).fetchall()
+        if row is None or row[0] == "null":
+            return None
+        route = Route.from_dict(json.loads(row[0]))
+        for (position,) in served:
+            route.consume(position)
+        return route, row[1]
+
+    def read_version(self, bus_id: int) -> int:
+        row = self.connection.execute(
+            "SELECT version FROM routes WHERE bus_id = ? AND route != 'null'", (bus_id,)
+        ).fetchone()
+        return 0 if row is None else row[0]
+
+    def version(self, bus_id):
+        with self.lock:
+            return self.read_version(bus_id)
+
+    def compare_and_set(self, bus_id, route, expected_version):
+        serialized = json.dumps(route.to_dict())
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            with self.connection:
+                if expected_version == 0:
+                    rows = self.connection.execute(
+                        "INSERT INTO routes (bus_id, version, route) VALUES (?, 1, ?) "
+                        "ON CONFLICT (bus_id) DO UPDATE SET version = version + 1, route = excluded.route "
+                        "WHERE route = 'null' RETURNING version",
+                        (bus_id, serialized)
+                    ).fetchall()
+                else:
+                    rows = self.connection.execute(
+                        "UPDATE routes SET version = version + 1, route = ? WHERE bus_id = ? AND version = ? "
+                        "AND route != 'null' RETURNING version",
+                        (serialized, bus_id, expected_version)
+                    ).fetchall()
+                if rows:
+                    # Served stops are part of the route that was just written
+                    self.connection.execute("DELETE FROM served_stops WHERE bus_id = ?", (bus_id,))
+            if not rows:
+                return 0
+            self.routes[bus_id] = (route, rows[0][0])
+            return rows[0][0]
+
+    def consume(self, bus_id, position, expected_version):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            with self.connection:
+                rows = self.connection.execute(
+                    "UPDATE routes SET version = version + 1 WHERE bus_id = ? AND version = ? "
+                    "AND route != 'null' RETURNING version",
+                    (bus_id, expected_version)
+                ).fetchall()
+                if rows:
+                    self.connection.execute(
+                        "INSERT INTO served_stops (bus_id, version, position) VALUES (?, ?, ?)",
+                        (bus_id, rows[0][0], position)
+                    )
+            if not rows:
+                return 0
+            entry = self.routes.get(bus_id)
+            if entry is not None and entry[1] == expected_version:
+                entry[0].consume(position)
+                self.routes[bus_id] = (entry[0], rows[0][0])
+            return rows[0][0]
+
+    def delete(self, bus_id):
+        with self.lock:
+            self.connection.execute("BEGIN IMMEDIATE")
+            with self.connection:
+                self.connection.execute(
+                    "UPDATE routes SET version = version + 1, route = 'null' WHERE bus_id = ?", (bus_id,)
+                )
+                self.connection.execute("DELETE FROM served_stops WHERE bus_id = ?", (bus_id,))
+            self.routes.pop(bus_id, None)
+
+    def bus_ids(self):
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT bus_id FROM routes WHERE route != 'null'")]
+
+
+def create_route_store(name: str, settings: Dict[str, str]) -> RouteStore:
+    if name == "memory":
+        return InProcessRouteStore()
+    if name == "sqlite":
+        return SqliteRouteStore(path=settings.get("ROUTE_STORE_PATH", "routes.sqlite"))
+    raise ValueError(f"Unknown route store {name}")
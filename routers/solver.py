@@ -0,0 +1,180 @@
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+from routers.lazy_import import lazy_import
+
+np = lazy_import("numpy")
+
+
+logger = logging.getLogger(__name__)
+
+# Routes with at most this many stops are solved exactly, larger ones heuristically
+exact_solver_max_stops = int(os.environ.get("EXACT_SOLVER_MAX_STOPS", 12))
+# Wall clock budget (in seconds) for the local search of the heuristic solver
+heuristic_time_budget = float(os.environ.get("HEURISTIC_TIME_BUDGET", 1.0))
+# One of "auto", "exact" or "heuristic"
+route_solver = os.environ.get("ROUTE_SOLVER", "auto")
+
+
+def path_cost(durations: "np.ndarray", order: List[int]) -> float:
+    return float(sum(durations[order[k], order[k + 1]] for k in range(len(order) - 1)))
+
+
+def solve_exact(durations: "np.ndarray") -> List[int]:
+    # Returning to the start is free, so the optimal tour is the optimal open path
+    # from stop 0. Durations may be asymmetric and the solve size stays n.
+    from python_tsp.exact import solve_tsp_dynamic_programming
+    open_path = durations.copy()
+    open_path[:, 0] = 0
+    permutation, _ = solve_tsp_dynamic_programming(open_path)
+    return [int(i) for i in permutation]
+
+
+def nearest_neighbour(durations: "np.ndarray") -> List[int]:
+    # Greedy construction of an open path starting at stop 0
+    n = len(durations)
+    order = [0]
+    visited = np.zeros(n, dtype=bool)
+    visited[0] = True
+    for _ in range(n - 1):
+        row = np.where(visited, np.inf, durations[order[-1]])
+        nearest = int(np.argmin(row))
+        visited[nearest] = True
+        order.append(nearest)
+    return order
+
+
+def two_opt_pass(durations: "np.ndarray", order: List[int], deadline: float) -> bool:
+    # Reverses the first improving segment of the path, the start stop stays fixed.
+    # Durations are asymmetric, so the reversed segment is priced with prefix sums
+    # of both the forward and the backward arc costs.
+    n = len(order)
+    forward = np.zeros(n)
+    backward = np.zeros(n)
+    for k in range(1, n):
+        forward[k] = forward[k - 1] + durations[order[k - 1], order[k]]
+        backward[k] = backward[k - 1] + durations[order[k], order[k - 1]]
+    for i in range(1, n - 1):
+        if time.monotonic() > deadline:
+            return False
+        for j in range(i + 1, n):
+            delta = durations[order[i - 1], order[j]] - durations[order[i - 1], order[i]]
+            delta += (backward[j] - backward[i]) - (forward[j] - forward[i])
+            if j < n - 1:
+                delta += durations[order[i], order[j + 1]] - durations[order[j], order[j + 1]]
+            if delta < -1e-9:
+                order[i:j + 1] = order[i:j + 1][::-1]
+                return True
+    return False
+
+
+def or_opt_pass(durations: "np.ndarray", order: List[int], deadline: float) -> bool:
+    # Moves the first improving chain of up to 3 consecutive stops to another position
+    n = len(order)
+    for length in (1, 2, 3):
+        for i in range(1, n - length + 1):
+            if time.monotonic() > deadline:
+                return False
+            j = i + length - 1
+            prev, first, last = order[i - 1], order[i], order[j]
+            removed = durations[prev, first]
+            added = 0.0
+            if j < n - 1:
+                removed += durations[last, order[j + 1]]
+                added += durations[prev, order[j + 1]]
+            rest = order[:i] + order[j + 1:]
+            for k in range(len(rest)):
+                if k == i - 1:
+                    continue
+                gain = durations[rest[k], first]
+                loss = 0.0
+                if k < len(rest) - 1:
+                    gain += durations[last, rest[k + 1]]
+                    loss = durations[rest[k], rest[k + 1]]
+                if gain - loss + added - removed < -1e-9:
+                    order[:] = rest[:k + 1] + order[i:j + 1] + rest[k + 1:]
+                    return True
+    return False
+
+
+def solve_heuristic(durations: "np.ndarray", time_budget: float = None) -> List[int]:
+    if time_budget is None:
+        time_budget = heuristic_time_budget
+    deadline = time.monotonic() + time_budget
+    order = nearest_neighbour(durations)
+    while time.monotonic() < deadline:
+        if two_opt_pass(durations, order, deadline):
+            continue
+        if or_opt_pass(durations, order, deadline):
+            continue
+        # Local optimum for both neighbourhoods
+        break
+    return order
+
+
+SOLVERS: "Dict[str, Callable[[np.ndarray], List[int]]]" = {
+    "exact": solve_exact,
+    "heuristic": solve_heuristic,
+}
+
+
+def choose_solver(size: int) -> str:
+    if route_solver != "auto":
+        return route_solver
+    return "exact" if size <= exact_solver_max_stops else "heuristic"
+
+
+def solve_route(durations) -> Tuple[List[int], Dict[str, Any]]:
+    """
+    Orders the stops of an open path starting at stop 0
+
+    Parameters:
+    - durations: Square matrix of travel times between the stops.
+
+    Returns:
+    The visiting order and a report with the solver used, the route size,
+    the route cost, the cost of the greedy construction and the latency.
+    """
+    durations = np.asarray(durations, dtype=float)
+    size = len(durations)
+    solver = choose_solver(size)
+    start = time.perf_counter()
+    order = SOLVERS[solver](durations) if size > 1 else list(range(size))
+    elapsed = time.perf_counter() - start
+    report = {
+        "solver": solver,
+        "size": size,
+        "cost": path_cost(durations, order),
+        "greedy_cost": path_cost(durations, nearest_neighbour(durations)) if size > 1 else 0.0,
+        "elapsed_ms": round(elapsed * 1000, 3),
+    }
+    logger.info("Solved route: %s", report)
+    return order, report
+
+
+def cheapest_insertion(order: List[Any], new: Any, cost: Callable[[Any, Any], float]) -> Tuple[int, float]:
+    """
+    Finds where to insert a stop into an open path so that its cost grows the least
+
+    Parameters:
+    - order: Current visiting order.
+    - new: Stop to insert.
+    - cost: Travel time between two stops.
+
+    Returns:
+    The position to insert the stop at and the added cost.
+    """
+    if not order:
+        return 0, 0.0
+    best_position, best_cost = 0, cost(new, order[0])
+    for position in range(1, len(order)):
+        prev, following = order[position - 1], order[position]
+        added = cost(prev, new) + cost(new, following) - cost(prev, following)
+        if added < best_cost:
+            best_position, best_cost = position, added
+    added = cost(order[-1], new)
+    if added < best_cost:
+        best_position, best_cost = len(order), added
+    return best_position, best_cost
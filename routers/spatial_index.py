@@ -0,0 +1,151 @@
+import logging
+import math
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from routers.geometry import decode_points, haversine_meters
+from routers.lazy_import import lazy_import
+from routers.stop_loader import load_active_stops, load_stops
+
+
+np = lazy_import("numpy")
+
+logger = logging.getLogger(__name__)
+
+METERS_PER_DEGREE = 111320.0
+
+
+class StopIndex(object):
+    """
+    In-memory grid over the coordinates of every active stop
+
+    Stops are bucketed into square cells of cell_size degrees, so nearest-stop
+    and bounding box queries only look at the cells they overlap. The index
+    is updated when stops are created or served, and reloaded from the
+    database every ttl seconds to pick up changes made by other workers.
+    """
+
+    stops: Dict[int, Dict[str, Any]]
+    cells: "Dict[Tuple[int, int], np.ndarray]"
+
+    def __init__(self, cell_size: float, ttl: float) -> None:
+        self.cell_size = cell_size
+        self.ttl = ttl
+        self.stops = dict()
+        self.loaded_at = None
+        self.lock = threading.Lock()
+        # Built by the first refresh, which every query starts with
+        self.rows = []
+        self.cells = dict()
+        self.dirty = False
+
+    def build(self, stops: List[Dict[str, Any]]) -> None:
+        # Arrays are rebuilt as a whole, which is cheap next to a database round trip
+        self.rows = list(stops)
+        self.coordinates = decode_points([stop["location"] for stop in self.rows]).reshape(-1, 2)
+        cell_ids = np.floor(self.coordinates / self.cell_size).astype(np.int64)
+        buckets = dict()
+        for i, cell in enumerate(map(tuple, cell_ids)):
+            buckets.setdefault(cell, []).append(i)
+        self.cells = {cell: np.array(indices) for cell, indices in buckets.items()}
+        self.dirty = False
+
+    def refresh(self) -> None:
+        with self.lock:
+            if self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl:
+                if self.dirty:
+                    self.build(list(self.stops.values()))
+                return
+            stops = load_active_stops()
+            self.stops = {stop["stop_id"]: stop for stop in stops}
+            self.build(stops)
+            self.loaded_at = time.monotonic()
+            logger.info("Indexed %s active stops", len(stops))
+
+    def add(self, stop_id: int) -> None:
+        with self.lock:
+            if self.loaded_at is None:
+                return
+            for stop in load_stops([stop_id]):
+                self.stops[stop["stop_id"]] = stop
+                self.dirty = True
+
+    def remove(self, stop_id: int) -> None:
+        with self.lock:
+            if self.stops.pop(stop_id, None) is not None:
+                self.dirty = True
+
+    def candidates(self, min_long: float, min_lat: float, max_long: float, max_lat: float) -> "np.ndarray":
+        first = (math.floor(min_long / self.cell_size), math.floor(min_lat / self.cell_size))
+        last = (math.floor(max_long / self.cell_size), math.floor(max_lat / self.cell_size))
+        if (last[0] - first[0] + 1) * (last[1] - first[1] + 1) > len(self.cells):
+            # Cheaper to look at the occupied cells than at every cell in the box
+            found = [
+                indices for cell, indices in self.cells.items()
+                if first[0] <= cell[0] <= last[0] and first[1] <= cell[1] <= last[1]
+            ]
+        else:
+            found = [
+                self.cells[(x, y)]
+                for x in range(first[0], last[0] + 1)
+                for y in range(first[1], last[1] + 1)
+                if (x, y) in self.cells
+            ]
+        return np.concatenate(found) if found else np.zeros(0, dtype=np.int64)
+
+    def nearest(
+            self,
+            lat: float,
+            long: float,
+            limit: Optional[int] = None,
+            max_distance: Optional[float] = None
+    ) -> List[Dict[str, Any]]:
+        """
+        Lists the stops closest to a point
+
+        Parameters:
+        - lat, long: The point.
+        - limit: Maximum number of stops.
+        - max_distance: Distance cutoff in meters.
+
+        Returns:
+        Stops sorted by distance, with the id and dist_meters fields of the nearby_stops RPC.
+        """
+        self.refresh()
+        with self.lock:
+            rows, coordinates = self.rows, self.coordinates
+            if max_distance is None:
+                indices = np.arange(len(rows))
+            else:
+                lat_span = max_distance / METERS_PER_DEGREE
+                long_span = lat_span / max(math.cos(math.radians(lat)), 1e-6)
+                indices = self.candidates(long - long_span, lat - lat_span, long + long_span, lat + lat_span)
+        distances = haversine_meters([long, lat], coordinates[indices])[0]
+        if max_distance is not None:
+            within = distances <= max_distance
+            indices, distances = indices[within], distances[within]
+        order = np.argsort(distances, kind="stable")
+        if limit is not None:
+            order = order[:limit]
+        return [
+            {**rows[indices[i]], "id": rows[indices[i]]["stop_id"], "dist_meters": float(distances[i])}
+            for i in order
+        ]
+
+    def in_range(self, min_lat: float, min_long: float, max_lat: float, max_long: float) -> List[Dict[str, Any]]:
+        self.refresh()
+        with self.lock:
+            rows, coordinates = self.rows, self.coordinates
+            indices = self.candidates(min_long, min_lat, max_long, max_lat)
+        inside = coordinates[indices]
+        mask = (inside[:, 0] >= min_long) & (inside[:, 0] <= max_long) \
+            & (inside[:, 1] >= min_lat) & (inside[:, 1] <= max_lat)
+        return [rows[i] for i in indices[mask]]
+
+
+stop_index = StopIndex(
+    cell_size=float(os.environ.get("STOP_INDEX_CELL_SIZE", 0.01)),
+    ttl=float(os.environ.get("STOP_INDEX_TTL", 300)),
+)
@@ -1,53 +1,36 @@
+import json
+from datetime import datetime
 from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
+from typing import Any, Dict, Iterator, List, Optional
+
 from dependencies import get_current_user
 from models import User, supabase, UserEntity
+from routers.line_index import stop_line_index
+from routers.stop_counters import PARCEL_ENTITIES, stop_counters
 
 router = APIRouter(prefix="/statistics", tags=["statistics"])
 
 
-# Define the endpoint for getting statistics
-@router.get("/")
-def get_statistics(current_user: User = Depends(get_current_user)):
+def check_manager(current_user: User) -> None:
     if current_user.entity != UserEntity.manager:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail="Only parcel operators can get statistics",
         )
-        # TODO len, but must be count to avoid loading all data
+
+
+# Define the endpoint for getting statistics
+@router.get("/")
+def get_statistics(current_user: User = Depends(get_current_user)):
+    check_manager(current_user)
+    counts = stop_counters.get()
     statistics = {
-        "parcels_delivered": len(
-            supabase.table("stops")
-            .select("*")
-            .eq("is_active", False)
-            .in_("entity", ["parcel_pickup", "parcel_dropoff"])
-            .execute()
-            .data
-        ),  # parcels + passangers
-        "parcels_pending": len(
-            supabase.table("stops")
-            .select("*")
-            .eq("is_active", True)
-            .in_("entity", ["parcel_pickup", "parcel_dropoff"])
-            .execute()
-            .data
-        ),
+        "parcels_delivered": counts["parcels_delivered"],  # parcels + passangers
+        "parcels_pending": counts["parcels_pending"],
         "peak_hours": "11:43",
-        "passenger_transported": len(
-            supabase.table("stops")
-            .select("*")
-            .eq("is_active", False)
-            .eq("entity", "passenger_pickup")
-            .execute()
-            .data
-        ),
-        "passenger_transit": len(
-            supabase.table("stops")
-            .select("*")
-            .eq("is_active", True)
-            .eq("entity", "passenger_pickup")
-            .execute()
-            .data
-        ),
+        "passenger_transported": counts["passenger_transported"],
+        "passenger_transit": counts["passenger_transit"],
         "capacity_utilization": 80.8,
         "emissions": 0.129,
         "customer_retention": 73.4,
@@ -56,50 +39,98 @@ def get_statistics(current_user: User = Depends(get_current_user)):
     return {"data": statistics}
 
 
+# Only the columns an event is made of
+EVENT_COLUMNS = "stop_id,lat,long,updated_at,entity"
+
+
+def iter_event_pages(
+        since: Optional[datetime],
+        until: Optional[datetime],
+        after: Optional[int],
+        page_size: int
+) -> Iterator[List[Dict[str, Any]]]:
+    # Keyset pagination on stop_id, so every page costs the same however deep it is
+    while True:
+        query = supabase.table("stops")\
+            .select(EVENT_COLUMNS)\
+            .eq("is_active", False)\
+            .in_("entity", PARCEL_ENTITIES)
+        if since is not None:
+            query = query.gte("updated_at", since.isoformat())
+        if until is not None:
+            query = query.lt("updated_at", until.isoformat())
+        if after is not None:
+            query = query.gt("stop_id", after)
+        # TODO equal to parcel_status
+        events = query.order("stop_id").limit(page_size).execute().data
+        if not events:
+            return
+        bus_ids_by_stop = stop_line_index.lookup(event["stop_id"] for event in events)
+        yield [
+            {
+                "stop_id": event["stop_id"],
+                "lat": event["lat"],
+                "long": event["long"],
+                "updated_at": event["updated_at"],
+                "entity": event["entity"],
+                # Take the bus line with the smallest id, None for stops without one
+                "bus_stop_mapping": next(iter(bus_ids_by_stop[event["stop_id"]]), None),
+            }
+            for event in events
+        ]
+        if len(events) < page_size:
+            return
+        after = events[-1]["stop_id"]
+
+
 @router.get("/events")
-def get_events(current_user: User = Depends(get_current_user)):
-    if current_user.entity != UserEntity.manager:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Only parcel operators can get statistics",
-        )
-    # TODO equal to parcel_status
-    events = (
-        supabase.table("stops")
-        .select("*")
-        .eq("is_active", False)
-        .in_("entity", ["parcel_pickup", "parcel_dropoff"])
-        .execute()
-        .data
-    )
-
-    # Filter the events to include only stop_id, lat, long, and updated_at
-    # Get a list of stop_ids from the events
-    stop_ids = [event["stop_id"] for event in events]
-
-    # Find all corresponding entries in the bus_stop_mappings_table
-    bus_stop_mappings = (
-        supabase.table("bus_stop_mappings")
-        .select("*")
-        .in_("stop_id", stop_ids)
-        .execute()
-        .data
-    )
-
-    # Create a dictionary to map stop_id to bus_stop_mapping
-    stop_id_to_mapping = {mapping["stop_id"]: mapping for mapping in bus_stop_mappings}
-
-    # Filter the events to include only stop_id, lat, long, updated_at, and the corresponding bus_stop_mapping
-    filtered_events = [
-        {
-            "stop_id": event["stop_id"],
-            "lat": event["lat"],
-            "long": event["long"],
-            "updated_at": event["updated_at"],
-            "entity": event["entity"],
-            "bus_stop_mapping": stop_id_to_mapping.get(event["stop_id"])["bus_id"],
-        }
-        for event in events
-    ]
-
-    return {"data": filtered_events}
+def get_events(
+        current_user: User = Depends(get_current_user),
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        after: Optional[int] = None,
+        page_size: int = 500
+):
+    """
+    Lists delivered parcel events as {"data": [...]}, streamed page by page
+
+    Parameters:
+    - token (str): The user token.
+    - since, until (datetime): Only events updated in this time range.
+    - after (int): Only events with a greater stop_id, to resume a previous listing.
+    - page_size (int): Number of events fetched per query.
+    """
+    check_manager(current_user)
+
+    def body():
+        yield '{"data": ['
+        separator = ""
+        for page in iter_event_pages(since, until, after, page_size):
+            for event in page:
+                yield separator + json.dumps(event)
+                separator = ", "
+        yield "]}"
+
+    return StreamingResponse(body(), media_type="application/json")
+
+
+@router.get("/events/stream")
+def stream_events(
+        current_user: User = Depends(get_current_user),
+        since: Optional[datetime] = None,
+        until: Optional[datetime] = None,
+        after: Optional[int] = None,
+        page_size: int = 500
+):
+    """
+    Streams delivered parcel events as newline-delimited JSON, one event per line
+
+    Takes the same parameters as /statistics/events.
+    """
+    check_manager(current_user)
+
+    def body():
+        for page in iter_event_pages(since, until, after, page_size):
+            yield "".join(json.dumps(event) + "\n" for event in page)
+
+    return StreamingResponse(body(), media_type="application/x-ndjson")
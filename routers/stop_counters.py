@@ -0,0 +1,101 @@
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+from models import supabase, StopEntity
+
+
+PARCEL_ENTITIES = [StopEntity.parcel_pickup.value, StopEntity.parcel_dropoff.value]
+PASSENGER_ENTITIES = [StopEntity.passenger_pickup.value]
+
+# Counter name for stops of the given entities that are active (True) or served (False)
+COUNTERS: Dict[Tuple[str, bool], List[str]] = {
+    ("parcels_delivered", False): PARCEL_ENTITIES,
+    ("parcels_pending", True): PARCEL_ENTITIES,
+    ("passenger_transported", False): PASSENGER_ENTITIES,
+    ("passenger_transit", True): PASSENGER_ENTITIES,
+}
+
+
+class StopCounters(object):
+    """
+    Parcel and passenger counters kept up to date as stops are created and served
+
+    Counters are reconciled with count queries every reconcile_interval seconds,
+    which also picks up changes made by other workers. One caller reconciles at
+    a time while the others keep reading the current counts, and changes made
+    while the queries run are applied on top of their results.
+    """
+
+    counts: Dict[str, int]
+    # Changes made since the running reconciliation started, None when none is running
+    changes: Optional[Dict[str, int]]
+
+    def __init__(self, reconcile_interval: float) -> None:
+        self.reconcile_interval = reconcile_interval
+        self.counts = {name: 0 for name, _ in COUNTERS}
+        self.changes = None
+        self.reconciled_at = None
+        self.lock = threading.Lock()
+        # Notified when a reconciliation ends, the first counts are only known after one
+        self.reconciled = threading.Condition(self.lock)
+
+    def counter(self, entity: str, is_active: bool) -> Optional[str]:
+        for (name, active), entities in COUNTERS.items():
+            if active == is_active and entity in entities:
+                return name
+        return None
+
+    def increment(self, entity: str, is_active: bool, amount: int = 1) -> None:
+        name = self.counter(entity, is_active)
+        if name is not None:
+            with self.lock:
+                self.counts[name] += amount
+                if self.changes is not None:
+                    self.changes[name] += amount
+
+    def created(self, entity: str) -> None:
+        self.increment(entity, True)
+
+    def served(self, entity: str) -> None:
+        self.increment(entity, True, -1)
+        self.increment(entity, False)
+
+    def reconcile(self) -> None:
+        # Expects the caller to have claimed the reconciliation by setting changes
+        counts = None
+        try:
+            counts = {
+                name: supabase.table("stops")
+                .select("stop_id", count="exact")
+                .eq("is_active", is_active)
+                .in_("entity", entities)
+                .limit(1)
+                .execute()
+                .count
+                for (name, is_active), entities in COUNTERS.items()
+            }
+        finally:
+            with self.lock:
+                if counts is not None:
+                    self.counts = {name: count + self.changes[name] for name, count in counts.items()}
+                    self.reconciled_at = time.monotonic()
+                self.changes = None
+                self.reconciled.notify_all()
+
+    def get(self) -> Dict[str, int]:
+        with self.lock:
+            due = self.reconciled_at is None or time.monotonic() - self.reconciled_at > self.reconcile_interval
+            claimed = due and self.changes is None
+            if claimed:
+                self.changes = {name: 0 for name in self.counts}
+            elif self.reconciled_at is None:
+                self.reconciled.wait_for(lambda: self.changes is None)
+        if claimed:
+            self.reconcile()
+        with self.lock:
+            return dict(self.counts)
+
+
+stop_counters = StopCounters(reconcile_interval=float(os.environ.get("STATISTICS_RECONCILE_INTERVAL", 60)))
@@ -0,0 +1,95 @@
+import os
+from typing import Any, Callable, Dict, Iterable, List
+
+from models import supabase
+
+
+# PostgREST answers with at most this many rows, larger tables are read page by page
+page_size = int(os.environ.get("SUPABASE_PAGE_SIZE", 1000))
+
+
+def load_pages(query: Callable[[], Any]) -> List[Dict[str, Any]]:
+    """
+    Reads every row of a query, one page at a time until a short page comes back
+
+    Parameters:
+    - query: Builds the query, which must have a stable order. Called again for every page.
+
+    Returns:
+    The rows of all pages.
+    """
+    rows = []
+    while True:
+        page = query().range(len(rows), len(rows) + page_size - 1).execute().data
+        rows.extend(page)
+        if len(page) < page_size:
+            return rows
+
+
+def load_stops(stop_ids: Iterable[int], columns: str = "*", active_only: bool = True) -> List[Dict[str, Any]]:
+    """
+    Loads stops by id with one query per page_size ids
+
+    Parameters:
+    - stop_ids: Ids of the stops to load.
+    - columns: Columns to select, stop_id is always included.
+    - active_only: Skip stops that were already served.
+
+    Returns:
+    Stops in the order of stop_ids.
+    """
+    stop_ids = list(dict.fromkeys(stop_ids))
+    if not stop_ids:
+        return []
+    if columns != "*" and "stop_id" not in [column.strip() for column in columns.split(",")]:
+        columns = f"stop_id,{columns}"
+    stops_by_id = dict()
+    # Every chunk fits in one response and keeps the query string short
+    for start in range(0, len(stop_ids), page_size):
+        query = supabase.table("stops").select(columns).in_("stop_id", stop_ids[start:start + page_size])
+        if active_only:
+            query = query.eq("is_active", True)
+        stops_by_id.update((stop["stop_id"], stop) for stop in query.execute().data)
+    return [stops_by_id[stop_id] for stop_id in stop_ids if stop_id in stops_by_id]
+
+
+def load_bus_stops(bus_ids: Iterable[int], columns: str = "*") -> Dict[int, List[Dict[str, Any]]]:
+    """
+    Loads the active stops of one or many bus lines with a few queries in total
+
+    Parameters:
+    - bus_ids: Ids of the bus lines.
+    - columns: Columns of the stops to select.
+
+    Returns:
+    Active stops of every bus line that has stop mappings, in stop_id order.
+    """
+    bus_ids = list(dict.fromkeys(bus_ids))
+    if not bus_ids:
+        return dict()
+    mappings = load_pages(
+        lambda: supabase.table("bus_stop_mappings")
+        .select("bus_id,stop_id")
+        .in_("bus_id", bus_ids)
+        .order("bus_id")
+        .order("stop_id")
+    )
+    stop_ids_by_bus = dict()
+    for mapping in mappings:
+        stop_ids_by_bus.setdefault(mapping["bus_id"], []).append(mapping["stop_id"])
+    stops = load_stops([mapping["stop_id"] for mapping in mappings], columns)
+    stops_by_id = {stop["stop_id"]: stop for stop in stops}
+    return {
+        bus_id: [stops_by_id[stop_id] for stop_id in stop_ids if stop_id in stops_by_id]
+        for bus_id, stop_ids in stop_ids_by_bus.items()
+    }
+
+
+def load_active_stops(columns: str = "*") -> List[Dict[str, Any]]:
+    return load_pages(lambda: supabase.table("stops").select(columns).eq("is_active", True).order("stop_id"))
+
+
+def load_bus_stop_mappings() -> List[Dict[str, Any]]:
+    return load_pages(
+        lambda: supabase.table("bus_stop_mappings").select("bus_id,stop_id").order("bus_id").order("stop_id")
+    )
@@ -1,10 +1,13 @@
 from fastapi import status, APIRouter, HTTPException, Depends
-from typing import Any, Dict, Iterable
+from typing import Any, Dict, Iterable, List, Optional, Tuple
 
 from dependencies import get_current_user
 from models import supabase, Stop, User, UserEntity, StopEntity
-from routers.bus import update_route, bus_routes
-from routers.algorithm import tsp_algorithm
+from routers.bus import ensure_route, load_route, update_route
+from routers.database_executor import run_blocking
+from routers.line_index import stop_line_index
+from routers.spatial_index import stop_index
+from routers.stop_counters import stop_counters
 
 
 router = APIRouter(prefix="/stops", tags=["stops"])
@@ -60,19 +63,24 @@ def supabase_create_stop(user: User, stop: Stop) -> Dict[str, Any]:
             detail="Stop creation failed",
         )
 
+    stop_index.add(response.data[0]["stop_id"])
+    stop_counters.created(stop.entity.value)
+    stop_line_index.add(response.data[0]["stop_id"], stop.bus_id)
     update_route(stop.bus_id, response.data[0]["stop_id"])
 
     return {"bus_id": stop.bus_id, **response.data[0]}
 
 
 def handle_dynamic_stop(user: User, stop: Stop) -> Dict[str, Any]:
-    nearest_stops = get_stops_sorted(lat=stop.lat, long=stop.long)["stops"]
+    nearest_stops = stop_index.nearest(lat=stop.lat, long=stop.long, max_distance=1000)
+    # Bus lines of every candidate at once instead of a query per candidate
+    bus_ids_by_stop = stop_line_index.lookup(nearest_stop["id"] for nearest_stop in nearest_stops)
     for nearest_stop in nearest_stops:
         nearest_stop_distance = nearest_stop["dist_meters"]
         if nearest_stop_distance > 1000:
             break
 
-        nearest_bus_id = get_nearest_bus_id(nearest_stop)
+        nearest_bus_id = get_nearest_bus_id(nearest_stop, bus_ids_by_stop)
         if nearest_bus_id is None:
             # No buses: try next closest stop
             continue
@@ -113,63 +121,74 @@ def create_stop(stop: Stop, current_user: User = Depends(get_current_user)):
     return supabase_create_stop(current_user, stop)
 
 
-def get_nearest_bus_id(nearest_stop):
+def get_nearest_bus_id(nearest_stop, bus_ids_by_stop: Optional[Dict[int, List[int]]] = None):
     nearest_stop_id = nearest_stop["id"]
-    response = supabase.table("bus_stop_mappings").select("bus_id").eq("stop_id", nearest_stop_id).execute()
-    # Check if response has data
-    if response.data:
-        # Take the bus line that comes first in the table
+    if bus_ids_by_stop is None:
+        bus_ids_by_stop = stop_line_index.lookup([nearest_stop_id])
+    bus_ids = bus_ids_by_stop.get(nearest_stop_id)
+    # Check if the stop is served by any bus line
+    if bus_ids:
+        # Take the bus line with the smallest id, the index keeps the lines of a stop sorted
         # TODO: (optional) add more complex logic here
-        return response.data[0]["bus_id"]
+        return bus_ids[0]
     else:
         return None
 
 
-# Define the endpoint for listing all active stops
-@router.get("/list")
-def list_stops(current_user: User = Depends(get_current_user)):
-    if current_user.entity == UserEntity.manager:
+def load_user_buses(current_user: User) -> Tuple[List[Dict[str, Any]], Optional[int]]:
+    # Buses shown to a driver or a passenger, and the line whose route they see
+    if current_user.entity == UserEntity.driver:
         busesList = supabase.table("buses")\
             .select("*")\
             .eq("is_active", True)\
-            .execute().data
-        stopsList = supabase.table("stops")\
-            .select("*")\
-            .eq("is_active", True)\
-            .in_("entity", ["parcel_pickup", "parcel_dropoff"])\
-            .execute().data
-    else:
-        if current_user.entity == UserEntity.driver:
-            busesList = supabase.table("buses")\
-                .select("*")\
-                .eq("is_active", True)\
-                .eq("driver_id", current_user.id).execute().data
-            if not busesList:
-                return {"buses": [], "stops": []}
-            bus_id = busesList[0]["bus_id"]
-        else:
-            # passenger
-            busIdList = supabase.rpc('bus_for_passenger', {"p_user_id": current_user.id}).execute().data
-            if not busIdList:
-                return {"buses": [], "stops": []}
-            bus_id = busIdList[0]["bus_id"]
-            busesList = supabase.table("buses")\
-                .select("*")\
-                .eq("is_active", True)\
-                .eq("bus_id", bus_id).execute().data
-            if not busesList:
-                return {"buses": [{"bus_id": bus_id, "lat": 0, "long": 0}], "stops": []}
-        if bus_id not in bus_routes:
-            bus_routes[bus_id] = tsp_algorithm(bus_id=bus_id)["stops"]
-        stopsList = bus_routes[bus_id]
+            .eq("driver_id", current_user.id).execute().data
+        if not busesList:
+            return [], None
+        return busesList, busesList[0]["bus_id"]
+    # passenger
+    busIdList = supabase.rpc('bus_for_passenger', {"p_user_id": current_user.id}).execute().data
+    if not busIdList:
+        return [], None
+    bus_id = busIdList[0]["bus_id"]
+    busesList = supabase.table("buses")\
+        .select("*")\
+        .eq("is_active", True)\
+        .eq("bus_id", bus_id).execute().data
+    if not busesList:
+        return [{"bus_id": bus_id, "lat": 0, "long": 0}], None
+    return busesList, bus_id
+
+
+def load_parcel_stops() -> Dict[str, Any]:
+    busesList = supabase.table("buses")\
+        .select("*")\
+        .eq("is_active", True)\
+        .execute().data
+    stopsList = supabase.table("stops")\
+        .select("*")\
+        .eq("is_active", True)\
+        .in_("entity", ["parcel_pickup", "parcel_dropoff"])\
+        .execute().data
     return {"buses": busesList, "stops": stopsList}
 
 
+# Define the endpoint for listing all active stops
+@router.get("/list")
+async def list_stops(current_user: User = Depends(get_current_user)):
+    if current_user.entity == UserEntity.manager:
+        return await run_blocking(load_parcel_stops)
+    busesList, bus_id = await run_blocking(load_user_buses, current_user)
+    if bus_id is None:
+        return {"buses": busesList, "stops": []}
+    await ensure_route(bus_id)
+    route, _ = await run_blocking(load_route, bus_id)
+    return {"buses": busesList, "stops": route.listed_stops()}
+
+
 # TODO doesn't need to be an endpoint, only used inside create_stop
 @router.get("/stops_sorted")
 def get_stops_sorted(_: User = Depends(get_current_user), lat: float = 0, long: float = 0):
-    response = supabase.rpc('nearby_stops', {"lat_position": lat, "long_position": long}).execute()
-    return {"stops": response.data}
+    return {"stops": stop_index.nearest(lat=lat, long=long)}
 
 
 @router.get("/stops_in_range")
@@ -180,10 +199,4 @@ def get_stops_in_range(
         max_lat: float = 0,
         max_long: float = 0
 ):
-    response = supabase\
-        .rpc(
-            'stops_in_range',
-            {"min_lat": min_lat, "min_long": min_long, "max_lat": max_lat, "max_long": max_long}
-        )\
-        .execute()
-    return {"stops": response.data}
+    return {"stops": stop_index.in_range(min_lat=min_lat, min_long=min_long, max_lat=max_lat, max_long=max_long)}
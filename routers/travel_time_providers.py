@@ -0,0 +1,99 @@
+import logging
+from typing import Dict, List, Optional
+
+from routers.geometry import haversine_meters
+from routers.lazy_import import lazy_import
+from routers.travel_time_store import coordinate_key
+
+
+np = lazy_import("numpy")
+rp = lazy_import("routingpy")
+
+logger = logging.getLogger(__name__)
+
+
+class TravelTimeProvider(object):
+
+    # Whether the travel times are worth persisting in the travel time store
+    cached: bool = False
+
+    def matrix(self, locations: List[List[float]], sources: List[int], destinations: List[int]) -> "np.ndarray":
+        """
+        Computes travel times between locations
+
+        Parameters:
+        - locations: (long, lat) pairs.
+        - sources: Indices of the locations to start from.
+        - destinations: Indices of the locations to arrive at.
+
+        Returns:
+        Matrix of travel times in seconds, one row per source and one column per destination.
+        """
+        raise NotImplementedError
+
+
+class GraphhopperProvider(TravelTimeProvider):
+
+    cached = True
+
+    def __init__(self, api_key: Optional[str], timeout: float) -> None:
+        self.api_key = api_key
+        self.timeout = timeout
+        self.client = None
+
+    def matrix(self, locations, sources, destinations):
+        # The client is created on the first request, importing routingpy and its HTTP stack with it
+        if self.client is None:
+            self.client = rp.Graphhopper(api_key=self.api_key, timeout=self.timeout)
+        # TODO check if bus is available
+        response = self.client.matrix(locations=locations, profile='car', sources=sources, destinations=destinations)
+        return np.array(response.durations, dtype=float)
+
+
+class HaversineProvider(TravelTimeProvider):
+
+    def __init__(self, speed_kmh: float, detour_factor: float) -> None:
+        # Straight line distance is stretched by the detour factor to approximate the road network
+        self.meters_per_second = speed_kmh / 3.6
+        self.detour_factor = detour_factor
+
+    def matrix(self, locations, sources, destinations):
+        locations = np.asarray(locations, dtype=float)
+        meters = haversine_meters(locations[sources], locations[destinations])
+        return meters * self.detour_factor / self.meters_per_second
+
+
+class MatrixFileProvider(TravelTimeProvider):
+
+    indices: Dict[str, int]
+
+    def __init__(self, path: str) -> None:
+        # .npz file with "coordinates" as (n, 2) (long, lat) pairs and "durations" as (n, n) seconds
+        with np.load(path) as data:
+            self.durations = np.asarray(data["durations"], dtype=float)
+            coordinates = data["coordinates"]
+        self.indices = {coordinate_key(coordinate): i for i, coordinate in enumerate(coordinates)}
+
+    def matrix(self, locations, sources, destinations):
+        try:
+            rows = [self.indices[coordinate_key(locations[i])] for i in sources]
+            columns = [self.indices[coordinate_key(locations[i])] for i in destinations]
+        except KeyError as e:
+            raise ValueError(f"Location {e} is missing from the travel time matrix file")
+        return self.durations[np.ix_(rows, columns)]
+
+
+def create_provider(name: str, settings: Dict[str, str]) -> TravelTimeProvider:
+    if name == "graphhopper":
+        return GraphhopperProvider(
+            api_key=settings.get("GRAPHOPPER_API_KEY"),
+            timeout=float(settings.get("GRAPHHOPPER_TIMEOUT", 10)),
+        )
+    if name == "haversine":
+        return HaversineProvider(
+            speed_kmh=float(settings.get("HAVERSINE_SPEED_KMH", 30)),
+            detour_factor=float(settings.get("HAVERSINE_DETOUR_FACTOR", 1.3)),
+        )
+    if name == "matrix_file":
+        return MatrixFileProvider(path=settings.get("TRAVEL_TIME_MATRIX_PATH", "travel_times.npz"))
+    raise ValueError(f"Unknown travel time provider {name}")
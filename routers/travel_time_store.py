@@ -0,0 +1,160 @@
+import logging
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from routers.lazy_import import lazy_import
+
+
+np = lazy_import("numpy")
+
+logger = logging.getLogger(__name__)
+
+# Coordinates are rounded so that the same stop always maps to the same key
+COORDINATE_PRECISION = 6
+
+# Fetches the travel times from sources to destinations (indices into locations)
+MatrixFetcher = Callable[[List[List[float]], List[int], List[int]], List[List[float]]]
+
+
+def coordinate_key(coordinate) -> str:
+    return f"{round(float(coordinate[0]), COORDINATE_PRECISION)},{round(float(coordinate[1]), COORDINATE_PRECISION)}"
+
+
+class TravelTimeStore(object):
+
+    entries: Dict[Tuple[str, str], Tuple[float, float]]
+
+    def __init__(self, path: str, ttl: float) -> None:
+        self.path = path
+        self.ttl = ttl
+        self.entries = dict()
+        self.lock = threading.Lock()
+        # The database is opened and read on the first lookup rather than when the API starts
+        self.connection = None
+        self.loaded = False
+
+    def connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS travel_times ("
+            "source TEXT NOT NULL, "
+            "destination TEXT NOT NULL, "
+            "duration REAL NOT NULL, "
+            "fetched_at REAL NOT NULL, "
+            "PRIMARY KEY (source, destination))"
+        )
+        return connection
+
+    def load(self) -> None:
+        # Read every entry that has not expired yet and drop the rest
+        oldest = time.time() - self.ttl
+        with self.lock:
+            if self.loaded:
+                return
+            self.connection = self.connect()
+            self.connection.execute("DELETE FROM travel_times WHERE fetched_at < ?", (oldest,))
+            self.connection.commit()
+            rows = self.connection.execute("SELECT source, destination, duration, fetched_at FROM travel_times")
+            for source, destination, duration, fetched_at in rows:
+                self.entries[(source, destination)] = (duration, fetched_at)
+            self.loaded = True
+        logger.info("Loaded %s cached travel times", len(self.entries))
+
+    def refresh(self, keys: List[str]) -> None:
+        # Other processes may have stored travel times between these locations since the last load
+        keys = list(set(keys))
+        placeholders = ",".join("?" * len(keys))
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT source, destination, duration, fetched_at FROM travel_times "
+                f"WHERE source IN ({placeholders}) AND destination IN ({placeholders})",
+                keys + keys
+            ).fetchall()
+            for source, destination, duration, fetched_at in rows:
+                self.entries[(source, destination)] = (duration, fetched_at)
+
+    def lookup(self, source: str, destination: str, now: float) -> Optional[float]:
+        if source == destination:
+            return 0.0
+        entry = self.entries.get((source, destination))
+        if entry is None or now - entry[1] > self.ttl:
+            return None
+        return entry[0]
+
+    def save(self, keys: List[str], sources: List[int], destinations: List[int], durations, now: float) -> None:
+        rows = [
+            (keys[source], keys[destination], float(durations[i][j]), now)
+            for i, source in enumerate(sources)
+            for j, destination in enumerate(destinations)
+            if durations[i][j] is not None
+        ]
+        with self.lock:
+            for source, destination, duration, fetched_at in rows:
+                self.entries[(source, destination)] = (duration, fetched_at)
+            self.connection.executemany("INSERT OR REPLACE INTO travel_times VALUES (?, ?, ?, ?)", rows)
+            self.connection.commit()
+
+    def fill(self, durations: "np.ndarray", keys: List[str], now: float) -> Set[Tuple[int, int]]:
+        # Copies known travel times into durations and returns the unknown pairs
+        missing_pairs = set()
+        for i in range(len(keys)):
+            for j in range(len(keys)):
+                duration = self.lookup(keys[i], keys[j], now)
+                if duration is None:
+                    missing_pairs.add((i, j))
+                else:
+                    durations[i, j] = duration
+        return missing_pairs
+
+    def get_matrix(self, coordinates, fetch: MatrixFetcher) -> "np.ndarray":
+        """
+        Builds the travel time matrix between coordinates, fetching only what is not cached
+
+        Parameters:
+        - coordinates: (long, lat) pairs.
+        - fetch: Requests travel times from the provider for the given sources and destinations.
+
+        Returns:
+        Square matrix of travel times in seconds.
+        """
+        if not self.loaded:
+            self.load()
+        keys = [coordinate_key(coordinate) for coordinate in coordinates]
+        n = len(keys)
+        now = time.time()
+        durations = np.zeros((n, n))
+        missing_pairs = self.fill(durations, keys, now)
+        if missing_pairs:
+            self.refresh(keys)
+            missing_pairs = self.fill(durations, keys, now)
+        if not missing_pairs:
+            return durations
+        # Greedily pick the locations whose rows and columns cover every unknown pair
+        missing = set()
+        while missing_pairs:
+            counts = np.zeros(n, dtype=int)
+            for i, j in missing_pairs:
+                counts[i] += 1
+                counts[j] += 1
+            worst = int(np.argmax(counts))
+            missing.add(worst)
+            missing_pairs = {(i, j) for i, j in missing_pairs if worst not in (i, j)}
+        locations = [list(coordinate) for coordinate in coordinates]
+        everything = list(range(n))
+        if 2 * len(missing) >= n:
+            # Two partial requests would cost as much as the full matrix
+            requests = [(everything, everything)]
+        else:
+            # Rows and columns of the stops with unknown travel times
+            missing = sorted(missing)
+            requests = [(missing, everything), (everything, missing)]
+        for sources, destinations in requests:
+            fetched = fetch(locations, sources, destinations)
+            self.save(keys, sources, destinations, fetched, now)
+            for i, source in enumerate(sources):
+                for j, destination in enumerate(destinations):
+                    durations[source, destination] = fetched[i][j]
+        logger.info("Fetched travel times for %s of %s locations", len(missing), n)
+        return durations
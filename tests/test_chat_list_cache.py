@@ -0,0 +1,32 @@
+import asyncio
+
+from routers.broadcast_bus import UnixSocketBroadcastBus
+from routers.chat_list_cache import ChatListCache
+from routers.connection_handler import ConnectionHandler
+
+
+def make_worker(directory: str):
+    cache = ChatListCache(ttl=float("inf"), max_size=10)
+    bus = UnixSocketBroadcastBus(directory, max_buffer_size=1024 * 1024, discovery_interval=0)
+    return cache, ConnectionHandler(bus, 10, 1, "drop_oldest", on_deliver=cache.deliver)
+
+
+def test_previews_follow_messages_of_other_workers(tmp_path):
+    async def scenario():
+        sender_cache, sender = make_worker(str(tmp_path))
+        reader_cache, reader = make_worker(str(tmp_path))
+        # Neither worker serves a socket of the chat
+        await sender.bus.start(sender.deliver)
+        await reader.bus.start(reader.deliver)
+        reader_cache.put(7, [{"id": 1, "last_message": "", "time": ""}])
+        message = {"id": None, "chat_id": 1, "sender_id": 8, "text": "hi", "created_at": "2024-01-01T10:15:00+00:00"}
+        await sender.broadcast(1, message)
+        await asyncio.sleep(0.1)
+        assert reader_cache.get(7) == [{"id": 1, "last_message": "hi", "time": "10:15"}]
+        await sender.broadcast(2, {"invalidate_users": [7]})
+        await asyncio.sleep(0.1)
+        assert reader_cache.get(7) is None
+        sender.bus.close()
+        reader.bus.close()
+
+    asyncio.run(scenario())
@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+from fastapi import WebSocketDisconnect
+from starlette.websockets import WebSocketState
+
+from models import User, UserEntity
+from routers import chats
+from routers.broadcast_bus import InProcessBroadcastBus
+from routers.connection_handler import ConnectionHandler
+from routers.message_writer import MessageWriter
+
+# Latency of every Supabase round trip
+QUERY_SECONDS = 0.1
+
+
+class Response(object):
+
+    def __init__(self, data) -> None:
+        self.data = data
+
+
+class BlockingQuery(object):
+    # Stands in for the synchronous Supabase client, every execute blocks its thread
+
+    def __init__(self, table: str) -> None:
+        self.table = table
+        self.filters = dict()
+
+    def __getattr__(self, name: str):
+        return lambda *args, **kwargs: self
+
+    def eq(self, column: str, value):
+        self.filters[column] = value
+        return self
+
+    def execute(self) -> Response:
+        time.sleep(QUERY_SECONDS)
+        if self.table == "chats":
+            chat_id = self.filters["id"]
+            return Response([{"id": chat_id, "driver_id": chat_id, "user_id": 1000 + chat_id}])
+        return Response([])
+
+
+class BlockingClient(object):
+
+    def table(self, name: str) -> BlockingQuery:
+        return BlockingQuery(name)
+
+
+class FakeWebSocket(object):
+    # Disconnects right after the history was loaded
+
+    client_state = WebSocketState.CONNECTED
+
+    async def accept(self) -> None:
+        pass
+
+    async def receive_text(self) -> str:
+        self.client_state = WebSocketState.DISCONNECTED
+        raise WebSocketDisconnect()
+
+    async def send_json(self, message) -> None:
+        pass
+
+    async def close(self, code: int = 1000) -> None:
+        self.client_state = WebSocketState.DISCONNECTED
+
+
+def make_driver(user_id: int) -> User:
+    return User(
+        id=user_id,
+        password="",
+        entity=UserEntity.driver,
+        first_name="",
+        last_name="",
+        email=""
+    )
+
+
+def test_concurrent_chats_query_in_parallel(monkeypatch):
+    monkeypatch.setattr(chats, "supabase", BlockingClient())
+    monkeypatch.setattr(chats, "connection_handler", ConnectionHandler(InProcessBroadcastBus(), 10, 1, "drop_oldest"))
+    monkeypatch.setattr(chats, "message_writer", MessageWriter(max_batch_size=10, max_delay=0.01, max_attempts=1))
+    num_chats = 8
+
+    async def scenario() -> float:
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            chats.open_chat(FakeWebSocket(), chat_id, make_driver(chat_id), history_limit=10)
+            for chat_id in range(1, num_chats + 1)
+        ])
+        elapsed = time.perf_counter() - start
+        await chats.message_writer.close()
+        return elapsed
+
+    elapsed = asyncio.run(scenario())
+    # Every chat looks itself up and loads its history, one after another on the event loop
+    # that would take 2 * num_chats round trips
+    assert elapsed < 2 * QUERY_SECONDS * 3
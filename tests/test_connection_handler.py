@@ -0,0 +1,36 @@
+import asyncio
+
+from routers.broadcast_bus import InProcessBroadcastBus
+from routers.connection_handler import ConnectionHandler
+
+
+class FakeWebSocket(object):
+
+    def __init__(self) -> None:
+        self.sent = []
+
+    async def send_json(self, message) -> None:
+        self.sent.append(message)
+
+    async def close(self) -> None:
+        pass
+
+
+def test_disconnect_of_replaced_socket_keeps_the_new_one():
+    async def scenario():
+        handler = ConnectionHandler(InProcessBroadcastBus(), 10, 1, "drop_oldest")
+        old_socket, new_socket = FakeWebSocket(), FakeWebSocket()
+        old = await handler.register(1, 42, old_socket)
+        new = await handler.register(1, 42, new_socket)
+        # The disconnect of the old socket is only noticed after the user reconnected
+        handler.close(1, 42, old)
+        await handler.broadcast(1, {"text": "hello"})
+        await asyncio.sleep(0.01)
+        assert handler.active_sockets == {1: {42: new}}
+        assert new_socket.sent == [{"text": "hello"}]
+        assert old_socket.sent == []
+        handler.close(1, 42, new)
+        assert handler.active_sockets == {1: {}}
+        await asyncio.gather(old.writer, new.writer, return_exceptions=True)
+
+    asyncio.run(scenario())
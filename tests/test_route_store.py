@@ -0,0 +1,68 @@
+import pytest
+
+from routers import bus
+from routers.route import Route
+from routers.route_store import InProcessRouteStore, SqliteRouteStore
+
+
+def make_stops(*stop_ids):
+    return [{"stop_id": stop_id, "entity": "static", "lat": 0, "long": 0} for stop_id in stop_ids]
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def route_store(request, tmp_path):
+    if request.param == "memory":
+        return InProcessRouteStore()
+    return SqliteRouteStore(str(tmp_path / "routes.sqlite"))
+
+
+def test_versions_stay_monotonic_across_delete(route_store):
+    assert route_store.compare_and_set(1, Route(make_stops(1, 2)), 0) == 1
+    route_store.delete(1)
+    assert route_store.get(1) is None
+    assert route_store.bus_ids() == []
+    # A writer still holding the deleted route must not overwrite the new one
+    assert route_store.compare_and_set(1, Route(make_stops(3)), 1) == 0
+    version = route_store.compare_and_set(1, Route(make_stops(4, 5)), 0)
+    assert version > 1
+    assert route_store.compare_and_set(1, Route(make_stops(6)), 1) == 0
+    route, stored_version = route_store.get(1)
+    assert stored_version == version
+    assert [stop["stop_id"] for stop in route.stops] == [4, 5]
+    assert route_store.bus_ids() == [1]
+
+
+def test_recomputed_route_is_not_served_from_cache(route_store, monkeypatch):
+    solutions = iter([make_stops(1, 2, 3), make_stops(4, 5, 6)])
+    monkeypatch.setattr(bus, "route_store", route_store)
+    monkeypatch.setattr(bus, "build_next_stops_cache", dict())
+    monkeypatch.setattr(bus.route_service, "compute", lambda bus_id, fresh=False: {"stops": next(solutions)})
+
+    route, version = bus.load_route(7)
+    assert bus.build_next_stops(7, route, version, num_next_stops=1)["current_stop"]["stop_id"] == 1
+    # update_route drops the route of a line without active buses, the next read solves it again
+    route_store.delete(7)
+    route, version = bus.load_route(7)
+    assert bus.build_next_stops(7, route, version, num_next_stops=1)["current_stop"]["stop_id"] == 4
+
+
+def test_served_stops_reach_other_processes(tmp_path):
+    path = str(tmp_path / "routes.sqlite")
+    writer, reader = SqliteRouteStore(path), SqliteRouteStore(path)
+    version = writer.compare_and_set(1, Route(make_stops(1, 2, 3, 4)), 0)
+    route, _ = reader.get(1)
+    version = writer.consume(1, 1, version)
+    assert writer.consume(1, 2, version - 1) == 0
+    version = writer.consume(1, 2, version)
+    # Caught up from the served stops, without reading the route again
+    assert reader.get(1) == (route, version)
+    assert route.active == [True, False, False, True]
+    assert route.step(0, True) == (3, True)
+    # A route written whole replaces the served stops
+    replaced = Route(make_stops(5, 6))
+    version = writer.compare_and_set(1, replaced, version)
+    version = writer.consume(1, 0, version)
+    route, stored_version = reader.get(1)
+    assert stored_version == version
+    assert [stop["stop_id"] for stop in route.stops] == [5, 6]
+    assert route.active == [False, True]